@@ -4,18 +4,26 @@ bounding polygon and datetime period provided by the caller.
 
 Authors: Masha Liukis, Alex Gardner, Mark Fahnestock
 """
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import ctypes
+from dataclasses import dataclass
 from dateutil.parser import parse
 from datetime import datetime, timedelta
 import gc
 import geopandas as gpd
 import glob
+import h5netcdf
+import io
+import itertools
 import json
 import logging
 import os
 from pathlib import Path
 import psutil
 import pyproj
+import re
 import shutil
 import time
 import timeit
@@ -28,6 +36,8 @@ import pandas as pd
 import rioxarray
 import s3fs
 import subprocess
+import sys
+import threading
 from tqdm import tqdm
 import xarray as xr
 from urllib.parse import urlparse
@@ -67,6 +77,42 @@ Y_ATTRS = {
     DataVars.DESCRIPTION_ATTR: Coords.DESCRIPTION[Coords.Y]
 }
 
+# glibc library to return freed memory to the OS, if available
+try:
+    LIBC = ctypes.CDLL("libc.so.6")
+
+except OSError:
+    LIBC = None
+
+
+@dataclass
+class LayerResult:
+    """
+    Result of granule pre-processing for the datacube layer.
+    """
+    # Python 3.9 does not support dataclass(slots=True): define slots explicitly
+    __slots__ = ('empty', 'projection', 'mid_date', 'url', 'data', 'attrs')
+
+    # Flag if granule does not contain any data for the datacube region
+    empty: bool
+
+    # Source projection of the granule
+    projection: int
+
+    # Middle date for the layer, None if granule does not qualify as the layer
+    mid_date: datetime
+
+    # Original URL of the granule
+    url: str
+
+    # Granule data cropped to the datacube region, None if granule does not
+    # qualify as the layer
+    data: xr.Dataset
+
+    # Layer attributes that become datacube's data variables
+    # (see ITSCube.get_layer_attrs())
+    attrs: dict
+
 
 class ITSCube:
     """
@@ -79,8 +125,15 @@ class ITSCube:
     # Number of threads for parallel processing
     NUM_THREADS = 4
 
-    # Dask scheduler for parallel processing
+    # Dask scheduler for parallel processing: one of "processes", "threads",
+    # or "distributed" (local distributed cluster of one worker process running
+    # NUM_THREADS threads, which shares S3 connections between the tasks)
     DASK_SCHEDULER = "processes"
+    DASK_SCHEDULERS = ["processes", "threads", "distributed"]
+
+    # S3 file system objects per thread to read granules with: these are
+    # created by Dask workers rather than being pickled with each of the tasks
+    S3_THREAD_LOCAL = threading.local()
 
     # String representation of longitude/latitude projection
     LON_LAT_PROJECTION = 'EPSG:4326'
@@ -113,6 +166,17 @@ class ITSCube:
     # Engine to read xarray data into from NetCDF filecompression
     NC_ENGINE = 'h5netcdf'
 
+    # Keyword arguments for h5py.File when opening granules with h5netcdf engine:
+    # larger raw data chunk cache to avoid re-reading the same HDF5 chunks.
+    H5_DRIVER_KWDS = {
+        'rdcc_nbytes': 16*1024*1024
+    }
+
+    # Name phony dimensions of HDF5 datasets without dimension scales (if any)
+    # in the order of datasets within the file instead of failing to open
+    # the granule
+    H5_PHONY_DIMS = 'sort'
+
     # Date format as it appears in granules filenames:
     # (LC08_L1TP_011002_20150821_20170405_01_T1_X_LC08_L1TP_011002_20150720_20170406_01_T1_G0240V01_P038.nc)
     DATE_FORMAT = "%Y%m%d"
@@ -121,15 +185,83 @@ class ITSCube:
     DATE_TIME_NO_MICROSECS_FORMAT = '%Y%m%dT%H:%M:%S'
     DATE_TIME_FORMAT = '%Y%m%dT%H:%M:%S.%f'
 
+    # Regular expression for date and time as they appear in granules
+    # attributes (YYYYMMDD[THH:MM:SS[.ffffff]]) to parse them without
+    # dateutil.parser.parse() or datetime.strptime()
+    DATE_TIME_RE = re.compile(r'(\d{4})(\d{2})(\d{2})(?:T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?)?')
+
     # Granules are written to the file in chunks to avoid out of memory issues.
     # Number of granules to write to the file at a time.
     NUM_GRANULES_TO_WRITE = 1000
 
+    # Number of granules each of the parallel tasks reads and pre-processes:
+    # reading and pre-processing of the granules are fused into a single task
+    # per group of granules to amortize Dask scheduling overhead
+    NUM_GRANULES_PER_TASK = 32
+
+    # Number of granules to download concurrently ahead of their pre-processing
+    # within each of the parallel tasks
+    NUM_PREFETCH_GRANULES = 8
+
+    # Default size of the connection pool of S3 client: the pool is extended
+    # to fit all concurrent granule downloads, so connections are re-used
+    # instead of being discarded and re-established for each of the downloads
+    S3_MAX_POOL_CONNECTIONS = 10
+
+    # Data type to collect layers middle dates in: middle dates carry
+    # microseconds token to make them unique (see preprocess_dataset())
+    MID_DATE_DTYPE = 'datetime64[us]'
+
     # Grid cell size for the datacube.
     CELL_SIZE = 240.0
 
     CHIP_SIZE_HEIGHT_NO_VALUE = 65535
 
+    # Data variables that are stored as int16 in the datacube: keep them as
+    # float32 in memory even if granules decode them into float64
+    FLOAT32_VARS = [
+        DataVars.V,
+        DataVars.VX,
+        DataVars.VY,
+        DataVars.V_ERROR,
+        DataVars.VA,
+        DataVars.VR,
+        DataVars.M11,
+        DataVars.M12
+    ]
+
+    # Attributes of v[xyar] data variables that become datacube's data
+    # variables (collected per layer by get_layer_attrs())
+    V_LAYER_ATTRS = [
+        DataVars.ERROR,
+        DataVars.ERROR_MASK,
+        DataVars.ERROR_MODELED,
+        DataVars.ERROR_SLOW,
+        DataVars.STABLE_SHIFT,
+        DataVars.STABLE_SHIFT_MASK,
+        DataVars.STABLE_SHIFT_SLOW
+    ]
+
+    # Flags of v[xyar] data variables that become datacube's data variables
+    # (collected per layer by get_layer_attrs() only if they exist)
+    V_LAYER_FLAGS = [
+        DataVars.FLAG_STABLE_SHIFT,
+        DataVars.STABLE_COUNT_MASK,
+        DataVars.STABLE_COUNT_SLOW
+    ]
+
+    # Data variables that all granules formats have: stack them into
+    # pre-allocated datacube arrays instead of concatenating with xr.concat()
+    STACK_LAYERS_VARS = [DataVars.V, DataVars.VX, DataVars.VY]
+
+    # Attribute xarray uses to store dimensions of the array in Zarr store
+    ZARR_DIMS_ATTR = '_ARRAY_DIMENSIONS'
+
+    # Compressor to apply when writing datacube to the Zarr store: LZ4 is
+    # much faster to compress than zlib at a comparable compression ratio for
+    # byte-shuffled data
+    ZARR_COMPRESSOR = zarr.Blosc(cname='lz4', clevel=5, shuffle=zarr.Blosc.SHUFFLE)
+
     # Chunking to apply when writing datacube to the Zarr store
     TIME_CHUNK_VALUE = 20000
     X_Y_CHUNK_VALUE = 10
@@ -137,6 +269,12 @@ class ITSCube:
     # Chunking to apply to 1d data variables when writing datacube to the Zarr store
     TIME_CHUNK_VALUE_1D = 200000
 
+    # Spatial size of the blocks 3d data variables are encoded and written to
+    # the Zarr store in (must be a multiple of X_Y_CHUNK_VALUE): only one block
+    # at a time is encoded by each of the writing threads instead of the whole
+    # data variable
+    WRITE_X_Y_CHUNK_VALUE = 10*X_Y_CHUNK_VALUE
+
     # ATTN: Character arrays size must be explicitely set before first write:
     # to avoid truncation of the data if first ever written block of data
     # has less than other blocks data in length.
@@ -161,6 +299,14 @@ class ITSCube:
     SPLIT_IMAGES_TOKEN = '_X_'
     IMAGE_TOKEN = '_'
 
+    # Regular expression to extract processing dates and tokens that identify
+    # the image pair (all but processing dates, percent valid pixels and file
+    # extension) from the granule's URL
+    FILENAME_TOKENS_RE = re.compile(
+        r'(?:^|/)(?P<id_1>[^_/]+_[^_/]+_[^_/]+_[^_/]+)_(?P<proc_1>\d{8})_(?P<id_2>[^/]*?)_X_'
+        r'(?P<id_3>[^_/]+_[^_/]+_[^_/]+_[^_/]+)_(?P<proc_2>\d{8})_(?P<id_4>[^_/]+_[^_/]+_[^_/]+)_'
+    )
+
 
     # If a list of granules to generate datacube from is provided through input
     # JSON file.
@@ -239,8 +385,16 @@ class ITSCube:
         # original granules URLs)
         self.ds = []
 
-        self.dates = []
+        # Middle dates are collected into pre-allocated array, self.num_dates
+        # is the number of collected dates
+        self.dates = ITSCube.init_dates()
+        self.num_dates = 0
         self.urls = []
+        # Attributes of the layers that become datacube's data variables
+        # (collected when granules are pre-processed)
+        self.layer_attrs = []
+        # Cells of the layers within datacube grid (see ITSCube.get_grid_cells())
+        self.grid_cells = {}
         self.num_urls_from_api = None
 
         # Keep track of skipped granules due to:
@@ -287,15 +441,13 @@ class ITSCube:
         """
         Clear current set of cube layers.
         """
-        self.ds = None
+        self.ds = []
         self.layers = None
-        self.dates = []
+        self.dates = ITSCube.init_dates()
+        self.num_dates = 0
         self.urls = []
-
-        # Call Python's garbage collector
-        gc.collect()
-
-        self.ds = []
+        self.layer_attrs = []
+        self.grid_cells = {}
 
     def clear(self):
         """
@@ -399,6 +551,7 @@ class ITSCube:
         """
         Skip duplicate granules (the ones that have earlier processing date(s))
         for the same path row granule for Landsat8 and Landsat9 data only.
+        Granules can be provided as any iterable (list or generator).
 
         Examples of the Landsat image pair filename with one of the images from L89 mission group:
         LC08_L1GT_007011_20130819_20200912_02_T2_X_LC08_L1GT_007011_20140806_20200911_02_T2_G0120V02_P044.nc
@@ -406,104 +559,96 @@ class ITSCube:
         """
         # Need to remove duplicate granules for the middle date: some granules
         # have newer processing date, keep those.
+        # Each granule ID maps to the list of (url, processing_date_1, processing_date_2)
+        # tuples, so already kept granules are never re-parsed.
         keep_urls = {}
         skipped_double_granules = []
 
         # Unique granules to return
         granules = []
 
-        # Get image pairs with at least one of the Landsat8/9 images
-        landsat89_granules = [
-            each for each in found_urls
-            if os.path.basename(each).split(ITSCube.SPLIT_IMAGES_TOKEN)[0].startswith(ITSCube.LANDSAT89_PREFIX) or
-            os.path.basename(each).split(ITSCube.SPLIT_IMAGES_TOKEN)[1].startswith(ITSCube.LANDSAT89_PREFIX)
-        ]
+        # Split image pairs into the ones with at least one of the Landsat8/9
+        # images and all other granules in a single pass over the granules
+        landsat89_granules = []
+
+        for each in found_urls:
+            if any(
+                each_image.startswith(ITSCube.LANDSAT89_PREFIX)
+                for each_image in os.path.basename(each).split(ITSCube.SPLIT_IMAGES_TOKEN)[:2]
+            ):
+                landsat89_granules.append(each)
+
+            else:
+                granules.append(each)
 
         if len(landsat89_granules) == 0:
             # There are no Landsat8 granules, no need to remove duplicates
-            return found_urls, skipped_double_granules
+            return granules, skipped_double_granules
 
-        else:
-            # Include non-Landsat89 granules into unique granules to return
-            # as they don't need to be searched for duplicates
-            granules = list(set(found_urls).difference(landsat89_granules))
-            logging.info(f'Number of non-Landsat89 granules: {len(granules)}')
-
-        for each_url in tqdm(landsat89_granules, ascii=True, desc=f'Skipping duplicate Landsat89 granules out of {len(landsat89_granules)} granules...'):
-            # Extract acquisition and processing dates
-            url_proc_1, url_proc_2, granule_id = \
-                ITSCube.get_tokens_from_filename(each_url)
+        # Include unique non-Landsat89 granules into granules to return
+        # as they don't need to be searched for duplicates
+        granules = list(dict.fromkeys(granules))
+        logging.info(f'Number of non-Landsat89 granules: {len(granules)}')
+
+        # Extract processing dates and image pair identifiers for all granules at once
+        tokens = ITSCube.get_tokens_from_filenames(landsat89_granules)
+
+        for each_url, url_proc_1, url_proc_2, granule_id in tqdm(
+            zip(landsat89_granules, tokens.proc_1.values, tokens.proc_2.values, tokens.id.values),
+            total=len(landsat89_granules),
+            ascii=True,
+            desc=f'Skipping duplicate Landsat89 granules out of {len(landsat89_granules)} granules...'
+        ):
             # logging.info(f'ID={granule_id} for granule={each_url}')
 
+            found_granules = keep_urls.get(granule_id)
+
+            if found_granules is None:
+                # This is a granule for new ID, append it to URLs to keep
+                keep_urls[granule_id] = [(each_url, url_proc_1, url_proc_2)]
+                continue
+
             # There is a granule for the mid_date already, check which processing
-            # time is newer, keep the one with newer processing date
-            if granule_id in keep_urls:
-                # Flag if newly found URL should be kept
-                keep_found_url = False
-
-                for found_url in keep_urls[granule_id]:
-                    # Check already found URLs for processing time
-                    found_proc_1, found_proc_2, found_granule_id = \
-                        ITSCube.get_tokens_from_filename(found_url)
-
-                    # IDs must match
-                    if granule_id != found_granule_id:
-                        raise RuntimeError(f'Mismatching IDs for each_url={each_url}: {granule_id} vs. found_url={found_url}: {found_granule_id}')
-
-                    # If both granules have identical processing time,
-                    # keep them both - granules might be in different projections,
-                    # any other than target projection will be handled later
-                    if url_proc_1 == found_proc_1 and \
-                            url_proc_2 == found_proc_2:
-                        keep_urls[granule_id].append(each_url)
-                        keep_found_url = True
-                        break
-
-                # There are no "identical" granules for "each_url", check if
-                # new granule has newer processing dates
-                if not keep_found_url:
-                    # Check if any of the found URLs have older processing time
-                    # than newly found URL
-                    remove_urls = []
-                    for found_url in keep_urls[granule_id]:
-                        # Check already found URL for processing time
-                        found_proc_1, found_proc_2, _ = \
-                            ITSCube.get_tokens_from_filename(found_url)
-
-                        if url_proc_1 >= found_proc_1 and \
-                                url_proc_2 >= found_proc_2:
-                            # The granule will need to be replaced with a newer
-                            # processed one
-                            remove_urls.append(found_url)
-
-                        elif url_proc_1 > found_proc_1:
-                            # There are few cases when proc_1 is newer in
-                            # each_url and proc_2 is newer in found_url, then
-                            # keep the granule with newer proc_1
-                            remove_urls.append(found_url)
-
-                    if len(remove_urls):
-                        # Some of the URLs need to be removed due to newer
-                        # processed granule
-                        logging.info(f"Skipping {remove_urls} in favor of new {each_url}")
-                        skipped_double_granules.extend(remove_urls)
-
-                        # Remove older processed granules
-                        keep_urls[granule_id][:] = [each for each in keep_urls[granule_id] if each not in remove_urls]
-                        # Add new granule with newer processing date
-                        keep_urls[granule_id].append(each_url)
+            # time is newer, keep the one with newer processing date.
+            # If both granules have identical processing time, keep them both -
+            # granules might be in different projections, any other than target
+            # projection will be handled later
+            if any(
+                url_proc_1 == found_proc_1 and url_proc_2 == found_proc_2
+                for _, found_proc_1, found_proc_2 in found_granules
+            ):
+                found_granules.append((each_url, url_proc_1, url_proc_2))
+                continue
+
+            # There are no "identical" granules for "each_url", check if any of
+            # the found URLs have older processing time than newly found URL.
+            # There are few cases when proc_1 is newer in each_url and proc_2 is
+            # newer in found_url, then keep the granule with newer proc_1
+            remove_urls = [
+                found_url for found_url, found_proc_1, found_proc_2 in found_granules
+                if (url_proc_1 >= found_proc_1 and url_proc_2 >= found_proc_2) or
+                url_proc_1 > found_proc_1
+            ]
 
-                    else:
-                        # New granule has older processing date, don't include
-                        logging.info(f"Skipping new {each_url} in favor of {keep_urls[granule_id]}")
-                        skipped_double_granules.append(each_url)
+            if len(remove_urls):
+                # Some of the URLs need to be removed due to newer
+                # processed granule
+                logging.info(f"Skipping {remove_urls} in favor of new {each_url}")
+                skipped_double_granules.extend(remove_urls)
+
+                # Remove older processed granules
+                remove_urls = set(remove_urls)
+                found_granules[:] = [each for each in found_granules if each[0] not in remove_urls]
+                # Add new granule with newer processing date
+                found_granules.append((each_url, url_proc_1, url_proc_2))
 
             else:
-                # This is a granule for new ID, append it to URLs to keep
-                keep_urls.setdefault(granule_id, []).append(each_url)
+                # New granule has older processing date, don't include
+                logging.info(f"Skipping new {each_url} in favor of {[each[0] for each in found_granules]}")
+                skipped_double_granules.append(each_url)
 
         for each in keep_urls.values():
-            granules.extend(each)
+            granules.extend(each_url for each_url, _, _ in each)
 
         logging.info(f'Keeping {len(granules)} unique granules, skipping {len(skipped_double_granules)} Landsat89 granules')
 
@@ -609,6 +754,31 @@ class ITSCube:
 
         return granules, cube_layers_to_delete
 
+    @staticmethod
+    def parse_date(value: str):
+        """
+        Convert date string of YYYYMMDD[THH:MM:SS[.ffffff]] format to datetime
+        object using integer conversion of its fields, fall back to
+        dateutil.parser.parse() for any other format.
+        """
+        date_match = ITSCube.DATE_TIME_RE.fullmatch(value)
+        if date_match is None:
+            return parse(value)
+
+        year, month, day, hour, minute, second, fraction = date_match.groups()
+        if hour is None:
+            return datetime(int(year), int(month), int(day))
+
+        return datetime(
+            int(year),
+            int(month),
+            int(day),
+            int(hour),
+            int(minute),
+            int(second),
+            int(fraction.ljust(6, '0')) if fraction is not None else 0
+        )
+
     @staticmethod
     def get_tokens_from_filename(filename):
         """
@@ -621,7 +791,7 @@ class ITSCube:
         # Get acquisition, processing date, path_row for both images from url and index_url
         url_tokens = os.path.basename(files[0]).split(ITSCube.IMAGE_TOKEN)
 
-        url_proc_date_1 = datetime.strptime(url_tokens[4], ITSCube.DATE_FORMAT)
+        url_proc_date_1 = ITSCube.parse_date(url_tokens[4])
 
         # Remove processing date from the first image name: don't replace date
         # token with an empty string as acquisition and processing dates can be
@@ -630,7 +800,7 @@ class ITSCube:
         id_tokens.extend(url_tokens[5:])
 
         url_tokens = os.path.basename(files[1]).split(ITSCube.IMAGE_TOKEN)
-        url_proc_date_2 = datetime.strptime(url_tokens[4], ITSCube.DATE_FORMAT)
+        url_proc_date_2 = ITSCube.parse_date(url_tokens[4])
 
         # Remove processing date and _Pxxx.nc from the second image name
         id_tokens.extend(url_tokens[:4])
@@ -640,28 +810,62 @@ class ITSCube:
 
         return url_proc_date_1, url_proc_date_2, id
 
-    def add_layer(self, is_empty, layer_projection, mid_date, url, data):
+    @staticmethod
+    def get_tokens_from_filenames(filenames: list):
         """
-        Examine the layer if it qualifies to be added as a cube layer.
+        Vectorized version of get_tokens_from_filename(): extract processing
+        dates for two images and unique identifier for the image pair from
+        all provided filenames at once.
+
+        Returns pd.DataFrame with 'proc_1', 'proc_2' (datetime) and 'id' (str) columns.
         """
+        tokens = pd.Series(filenames, dtype=object).str.extract(ITSCube.FILENAME_TOKENS_RE)
 
-        if data is not None:
+        if tokens.isnull().values.any():
+            invalid_files = [filenames[each] for each in np.flatnonzero(tokens.isnull().any(axis=1).values)]
+            raise RuntimeError(f'Unexpected image pair filename format for: {invalid_files}')
+
+        return pd.DataFrame({
+            'proc_1': pd.to_datetime(tokens.proc_1, format=ITSCube.DATE_FORMAT, cache=True),
+            'proc_2': pd.to_datetime(tokens.proc_2, format=ITSCube.DATE_FORMAT, cache=True),
+            'id': tokens.id_1.str.cat([tokens.id_2, tokens.id_3, tokens.id_4], sep=ITSCube.IMAGE_TOKEN)
+        })
+
+    @staticmethod
+    def init_dates():
+        """
+        Allocate array to collect middle dates for ITSCube.NUM_GRANULES_TO_WRITE
+        layers.
+        """
+        return np.empty(max(ITSCube.NUM_GRANULES_TO_WRITE, 1), dtype=ITSCube.MID_DATE_DTYPE)
+
+    def add_layer(self, layer: LayerResult):
+        """
+        Examine the layer if it qualifies to be added as a cube layer.
+        """
+        if layer.data is not None:
             # "Duplicate" granules are handled apriori for newly constructed
             #  cubes (see self.request_granules() method) and for updated cubes
             #  (see self.exclude_processed_granules() method).
             # print(f"Adding {url} for {mid_date}")
-            self.dates.append(mid_date)
-            self.ds.append(data)
-            self.urls.append(url)
+            if self.num_dates == len(self.dates):
+                # More layers than ITSCube.NUM_GRANULES_TO_WRITE are collected
+                self.dates = np.concatenate((self.dates, ITSCube.init_dates()))
+
+            self.dates[self.num_dates] = layer.mid_date
+            self.num_dates += 1
+            self.ds.append(layer.data)
+            self.urls.append(layer.url)
+            self.layer_attrs.append(layer.attrs)
 
         else:
-            if is_empty:
+            if layer.empty:
                 # Layer does not contain valid data for the region
-                self.skipped_granules[DataVars.SKIP_EMPTY_DATA].append(url)
+                self.skipped_granules[DataVars.SKIP_EMPTY_DATA].append(layer.url)
 
             else:
                 # Layer corresponds to other than target projection
-                self.skipped_granules[DataVars.SKIP_PROJECTION].setdefault(layer_projection, []).append(url)
+                self.skipped_granules[DataVars.SKIP_PROJECTION].setdefault(layer.projection, []).append(layer.url)
 
     @staticmethod
     def init_output_store(output_dir: str):
@@ -884,47 +1088,7 @@ class ITSCube:
                 dropped_ds = None
                 gc.collect()
 
-        start = 0
-        num_to_process = len(found_urls)
-
-        while num_to_process > 0:
-            # How many tasks to process at a time
-            num_tasks = ITSCube.NUM_GRANULES_TO_WRITE if num_to_process > ITSCube.NUM_GRANULES_TO_WRITE else num_to_process
-            tasks = [dask.delayed(self.read_s3_dataset)(each_file, s3) for each_file in found_urls[start:start+num_tasks]]
-            self.logger.info(f"Processing {len(tasks)} tasks out of {num_to_process} remaining")
-
-            results = None
-            with ProgressBar():  # Does not work with Client() scheduler
-                # If to collect performance report (need to define global Client - see above)
-                # with performance_report(filename=f"dask-report-{num_granules}.html"):
-                #     results = dask.compute(tasks)
-                results = dask.compute(
-                    tasks,
-                    scheduler=ITSCube.DASK_SCHEDULER,
-                    num_workers=ITSCube.NUM_THREADS
-                )
-
-            del tasks
-            gc.collect()
-
-            for each_ds in results[0]:
-                if len(each_ds[0]):
-                    # There were exceptions reading the data, log it
-                    self.logger.info('--->'.join(each_ds[0]))
-
-                self.add_layer(*each_ds[1:])
-
-            del results
-            gc.collect()
-
-            wrote_layers = self.combine_layers(output_dir, is_first_write)
-            if is_first_write and wrote_layers:
-                is_first_write = False
-
-            self.format_stats()
-
-            num_to_process -= num_tasks
-            start += num_tasks
+        self.process_granules(found_urls, output_dir, is_first_write)
 
         # Remove existing granules with older processing dates if any
 
@@ -954,58 +1118,153 @@ class ITSCube:
             return found_urls
 
         # Parallelize layer collection
-        s3 = s3fs.S3FileSystem()
-
         # In order to enable Dask profiling, need to create Dask client for
         # processing: using "processes" or "threads" scheduler
         # processes_scheduler = True if ITSCube.DASK_SCHEDULER == 'processes' else False
         # client = Client(processes=processes_scheduler, n_workers=ITSCube.NUM_THREADS)
         # # Use client to collect profile information
         # client.profile(filename=f"dask-profile-{num_granules}-parallel.html")
-        is_first_write = True
+        self.process_granules(found_urls, output_dir, is_first_write=True)
+
+        return found_urls
+
+    def process_granules(self, found_urls: list, output_dir: str, is_first_write: bool):
+        """
+        Read and pre-process granules in parallel, and write them to the datacube
+        in chunks of ITSCube.NUM_GRANULES_TO_WRITE layers.
+
+        Each of the parallel tasks reads ITSCube.NUM_GRANULES_PER_TASK granules:
+        granules are downloaded concurrently ahead of their pre-processing
+        to overlap S3 transfer with computations. Collected layers are written
+        to the Zarr store in the background while next chunk of granules is
+        being read.
+
+        found_urls: list
+            Granules URLs to process.
+        output_dir: str
+            Local datacube Zarr store to write layers to.
+        is_first_write: bool
+            Flag if it's the first write to the Zarr store.
+        """
         start = 0
         num_to_process = len(found_urls)
 
-        while num_to_process > 0:
-            # How many tasks to process at a time
-            num_tasks = ITSCube.NUM_GRANULES_TO_WRITE if num_to_process > ITSCube.NUM_GRANULES_TO_WRITE else num_to_process
-            tasks = [dask.delayed(self.read_s3_dataset)(each_file, s3) for each_file in found_urls[start:start+num_tasks]]
-            self.logger.info(f"Processing {len(tasks)} tasks out of {num_to_process} remaining")
-
-            results = None
-            with ProgressBar():  # Does not work with Client() scheduler
-                # If to collect performance report (need to define global Client - see above)
-                # with performance_report(filename=f"dask-report-{num_granules}.html"):
-                #     results = dask.compute(tasks)
-                results = dask.compute(
-                    tasks,
-                    scheduler=ITSCube.DASK_SCHEDULER,
-                    num_workers=ITSCube.NUM_THREADS
-                )
+        client = None
+        if ITSCube.DASK_SCHEDULER == 'distributed':
+            # Import only when requested as it's heavy to import
+            from dask.distributed import Client
+
+            # Threads of the single worker process share S3 connections, and
+            # tasks results don't need to be pickled
+            client = Client(processes=False, n_workers=1, threads_per_worker=ITSCube.NUM_THREADS)
+
+        # Collected layers are combined and written to the Zarr store in the
+        # background while next chunk of granules is being read. Appends to
+        # the Zarr store must be serial: there is at most one pending write,
+        # which must complete before next one is submitted.
+        pending_write = None
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as write_executor:
+                while num_to_process > 0:
+                    # How many granules to process at a time
+                    num_granules = ITSCube.NUM_GRANULES_TO_WRITE if num_to_process > ITSCube.NUM_GRANULES_TO_WRITE else num_to_process
+                    granules = found_urls[start:start+num_granules]
+
+                    # Don't pass S3 file system to the tasks: each of Dask workers
+                    # uses its own (see ITSCube.get_s3())
+                    tasks = [
+                        dask.delayed(self.read_s3_datasets)(granules[each_start:each_start+ITSCube.NUM_GRANULES_PER_TASK])
+                        for each_start in range(0, num_granules, ITSCube.NUM_GRANULES_PER_TASK)
+                    ]
+
+                    self.logger.info(f"Processing {num_granules} granules ({len(tasks)} tasks) out of {num_to_process} remaining")
+
+                    results = None
+                    if client is not None:
+                        # ProgressBar does not work with Client() scheduler
+                        results = client.compute(tasks, sync=True)
 
-            del tasks
-            gc.collect()
+                    else:
+                        with ProgressBar():
+                            # If to collect performance report (need to define global Client - see above)
+                            # with performance_report(filename=f"dask-report-{num_granules}.html"):
+                            #     results = dask.compute(tasks)
+                            results, = dask.compute(
+                                tasks,
+                                scheduler=ITSCube.DASK_SCHEDULER,
+                                num_workers=ITSCube.NUM_THREADS
+                            )
+
+                    del tasks, granules
+
+                    for exception_info, each_layer in itertools.chain.from_iterable(results):
+                        if len(exception_info):
+                            # There were exceptions reading the data, log it
+                            self.logger.info('--->'.join(exception_info))
+
+                        self.add_layer(each_layer)
+
+                    del results
+
+                    if pending_write is not None:
+                        is_first_write = self.finish_write(*pending_write, is_first_write)
+                        ITSCube.release_memory()
+
+                    writer = self.detach_layers()
+                    pending_write = (writer, write_executor.submit(writer.combine_layers, output_dir, is_first_write))
 
-            for each_ds in results[0]:
-                if len(each_ds[0]):
-                    # There were exceptions reading the data, log it
-                    self.logger.info('--->'.join(each_ds[0]))
+                    self.format_stats()
 
-                self.add_layer(*each_ds[1:])
+                    num_to_process -= num_granules
+                    start += num_granules
 
-            del results
+                if pending_write is not None:
+                    self.finish_write(*pending_write, is_first_write)
+
+            # Collect garbage once all layers are written to the store rather
+            # than after each chunk of layers
             gc.collect()
+            ITSCube.release_memory()
 
-            wrote_layers = self.combine_layers(output_dir, is_first_write)
-            if is_first_write and wrote_layers:
-                is_first_write = False
+        finally:
+            if client is not None:
+                client.close()
 
-            self.format_stats()
+    def detach_layers(self):
+        """
+        Hand currently collected layers over to a shallow copy of the cube,
+        which combines and writes them to the Zarr store, and reset layers
+        of this cube so it can collect new layers in the meantime.
+        """
+        writer = copy.copy(self)
+        # Skipped granules are written to the file by the writer while
+        # new layers are being collected
+        writer.skipped_granules = copy.deepcopy(self.skipped_granules)
 
-            num_to_process -= num_tasks
-            start += num_tasks
+        self.ds = []
+        self.dates = ITSCube.init_dates()
+        self.num_dates = 0
+        self.urls = []
+        self.layer_attrs = []
+        self.grid_cells = {}
+        self.layers = None
 
-        return found_urls
+        return writer
+
+    def finish_write(self, writer, write_future, is_first_write: bool):
+        """
+        Wait for the writer to complete writing of the layers to the Zarr store,
+        and carry over the state the writer has established for the datacube.
+        Return a flag if next write to the Zarr store is the first write.
+        """
+        wrote_layers = write_future.result()
+
+        self.autoRIFTParamFile = writer.autoRIFTParamFile
+        self.land_ice_mask = writer.land_ice_mask
+        self.floating_ice_mask = writer.floating_ice_mask
+
+        return is_first_write and not wrote_layers
 
     def get_data_var(self, ds: xr.Dataset, var_name: str, data_dtype: str = 'short', data_fill_value: int = DataVars.MISSING_VALUE):
         """
@@ -1085,7 +1344,7 @@ class ITSCube:
                         value = datetime.strptime(value, '%Y%m%dT%H:%M:%S')
 
                     elif len(value) >= 8:
-                        value = parse(value)
+                        value = ITSCube.parse_date(value)
 
                 except ValueError as exc:
                     raise RuntimeError(f"Error converting {value} to date format '%Y%m%d': {exc} for {var_name}.{attr_name} in {ds_url}")
@@ -1104,6 +1363,83 @@ class ITSCube:
 
         return missing_value
 
+    @staticmethod
+    def get_layer_attrs(ds: xr.Dataset, ds_url: str):
+        """
+        Collect attributes of the layer that become datacube's data variables,
+        so they are extracted (and converted to the datacube data types) only
+        once per granule when the granule is pre-processed.
+
+        ds: xarray dataset
+            Pre-processed dataset for the layer.
+        ds_url: str
+            URL that corresponds to the dataset.
+        """
+        layer_attrs = {
+            each: ITSCube.get_data_var_attr(
+                ds,
+                ds_url,
+                DataVars.ImgPairInfo.NAME,
+                each,
+                to_date=DataVars.ImgPairInfo.CONVERT_TO_DATE[each],
+                data_dtype=DataVars.ImgPairInfo.ALL_DTYPE.get(each)
+            ) for each in DataVars.ImgPairInfo.ALL
+        }
+        layer_attrs[DataVars.AUTORIFT_SOFTWARE_VERSION] = ds.attrs[DataVars.AUTORIFT_SOFTWARE_VERSION]
+
+        # Attributes of v[xyar] data variables, keyed by (variable, attribute)
+        for each_var in [DataVars.VX, DataVars.VY, DataVars.VA, DataVars.VR]:
+            for each_attr in ITSCube.V_LAYER_ATTRS:
+                layer_attrs[(each_var, each_attr)] = ITSCube.get_data_var_attr(
+                    ds,
+                    ds_url,
+                    each_var,
+                    each_attr,
+                    DataVars.MISSING_VALUE
+                )
+
+            # Flags are collected only if they exist for the variable
+            for each_attr in ITSCube.V_LAYER_FLAGS:
+                if each_var in ds and each_attr in ds[each_var].attrs:
+                    layer_attrs[(each_var, each_attr)] = ITSCube.get_data_var_attr(
+                        ds,
+                        ds_url,
+                        each_var,
+                        each_attr,
+                        data_dtype=np.int32
+                    )
+
+        # Attributes of M1[12] data variables
+        for each_var in [DataVars.M11, DataVars.M12]:
+            attr_name = f'{each_var}_{DataVars.DR_TO_VR_FACTOR}'
+            layer_attrs[(each_var, attr_name)] = ITSCube.get_data_var_attr(
+                ds,
+                ds_url,
+                each_var,
+                attr_name,
+                DataVars.MISSING_BYTE
+            )
+
+        return layer_attrs
+
+    def get_layer_attr_values(self, attr_key, data_dtype):
+        """
+        Return array of attribute values, as collected by ITSCube.get_layer_attrs(),
+        for all current layers. Raise an exception if attribute was not
+        collected for any of the layers.
+
+        attr_key: Key of the attribute within collected layer attributes.
+        data_dtype: Data type of the array.
+        """
+        def layer_values():
+            for attrs, url in zip(self.layer_attrs, self.urls):
+                if attr_key not in attrs:
+                    raise RuntimeError(f"{attr_key} is expected for {url}")
+
+                yield attrs[attr_key]
+
+        return np.fromiter(layer_values(), dtype=data_dtype, count=len(self.layer_attrs))
+
     def preprocess_dataset(self, ds: xr.Dataset, ds_url: str):
         """
         Pre-process ITS_LIVE dataset in preparation for the cube layer.
@@ -1113,8 +1449,10 @@ class ITSCube:
         ds_url: str
             URL that corresponds to the dataset.
 
-        Returns:
-        cube_v:     Filtered data array for the layer.
+        Returns LayerResult object:
+        data:       Filtered data for the layer.
+        attrs:      Dictionary of layer attributes that become datacube's data
+                    variables (see ITSCube.get_layer_attrs()).
         mid_date:   Middle date that corresponds to the velocity pair (uses date
                     separation as milliseconds)
         empty:      Flag to indicate if dataset does not contain any data for
@@ -1134,6 +1472,9 @@ class ITSCube:
         # Layer data
         mask_data = None
 
+        # Layer attributes that become datacube's data variables
+        layer_attrs = None
+
         # Layer middle date
         mid_date = None
 
@@ -1161,8 +1502,8 @@ class ITSCube:
             attr_name_1 = DataVars.ImgPairInfo.ACQUISITION_DATE_IMG1
             attr_name_2 = DataVars.ImgPairInfo.ACQUISITION_DATE_IMG2
 
-            acq1_datetime = parse(ds.img_pair_info.attrs[attr_name_1])
-            mid_date = acq1_datetime + (parse(ds.img_pair_info.attrs[attr_name_2]) - acq1_datetime)/2
+            acq1_datetime = ITSCube.parse_date(ds.img_pair_info.attrs[attr_name_1])
+            mid_date = acq1_datetime + (ITSCube.parse_date(ds.img_pair_info.attrs[attr_name_2]) - acq1_datetime)/2
 
             # Create unique "token" by using granule's centroid longitude/latitude to
             # increase uniqueness of the mid_date for the layer (xarray: can't drop layers
@@ -1177,29 +1518,41 @@ class ITSCube:
             # "141121" as microseconds
             mid_date += timedelta(microseconds=int(ds.img_pair_info.attrs[attr_name_1][2:8]))
 
-            # Define which points are within target polygon.
-            mask_lon = (ds.x >= self.grid_x_min) & (ds.x <= self.grid_x_max)
-            mask_lat = (ds.y >= self.grid_y_min) & (ds.y <= self.grid_y_max)
-            mask = (mask_lon & mask_lat)
-            if mask.values.sum() == 0:
-                # One or both masks resulted in no coverage
+            # Select points within target polygon: slice the granule by
+            # coordinates instead of masking the whole granule and dropping
+            # masked out rows and columns. Slice bounds have to be in the order
+            # of the granule's coordinates.
+            x_slice = slice(self.grid_x_min, self.grid_x_max)
+            if ds.x.values[0] > ds.x.values[-1]:
+                x_slice = slice(self.grid_x_max, self.grid_x_min)
+
+            y_slice = slice(self.grid_y_min, self.grid_y_max)
+            if ds.y.values[0] > ds.y.values[-1]:
+                y_slice = slice(self.grid_y_max, self.grid_y_min)
+
+            mask_data = ds.sel(x=x_slice, y=y_slice)
+
+            if mask_data.x.size == 0 or mask_data.y.size == 0:
+                # Granule does not cover datacube polygon
                 mask_data = None
                 mid_date = None
                 empty = True
 
             else:
-                mask_data = ds.where(mask, drop=True)
-
-                # Another way to filter (have to put min/max values in the order
-                # corresponding to the grid)
-                # cube_v = ds.v.sel(x=slice(self.grid_x.min(), self.grid_x.max()),
-                #                   y=slice(self.grid_y.max, self.grid_y.min)).copy()
-
                 # If it's a valid velocity layer, add it to the cube,
                 # and skip granules that have only one cell in cube's polygon
                 if np.any(mask_data.v.notnull()) and \
                         len(mask_data.x.values) > 1 and len(mask_data.y.values > 1):
                     mask_data = mask_data.load()
+                    layer_attrs = ITSCube.get_layer_attrs(mask_data, ds_url)
+
+                    # Cast float64 data (decoded by applying scale_factor) to
+                    # float32 on ingest to halve memory of collected layers
+                    for each_var in ITSCube.FLOAT32_VARS:
+                        if each_var in mask_data and mask_data[each_var].dtype == np.float64:
+                            each_encoding = mask_data[each_var].encoding
+                            mask_data[each_var] = mask_data[each_var].astype(np.float32)
+                            mask_data[each_var].encoding = each_encoding
 
                     # Verify that granule is defined on the same grid cell size as
                     # expected output datacube.
@@ -1215,7 +1568,7 @@ class ITSCube:
 
         # Have to return URL for the dataset, which is provided as an input to the method,
         # to track URL per granule in parallel processing
-        return empty, int(ds_projection), mid_date, ds_url, mask_data
+        return LayerResult(empty, int(ds_projection), mid_date, ds_url, mask_data, layer_attrs)
 
     def process_v_attributes(self, var_name: str, mid_date_coord):
         """
@@ -1268,10 +1621,7 @@ class ITSCube:
             # Special care must be taken of v[xy].stable_rmse in
             # optical legacy format vs. v[xy].v[xy]_error in radar format as these
             # are the same
-            error_data = [
-                ITSCube.get_data_var_attr(ds, url, var_name, each_attr, DataVars.MISSING_VALUE)
-                for ds, url in zip(self.ds, self.urls)
-            ]
+            error_data = self.get_layer_attr_values((var_name, each_attr), np.float32)
 
             error_name_desc = f'{each_attr}{_name_sep}{DataVars.ERROR_DESCRIPTION}'
             desc_str = None
@@ -1301,12 +1651,10 @@ class ITSCube:
             )
 
             # If attribute is propagated as cube's data var attribute, delete it
-            if each_attr in self.layers[var_name].attrs:
-                del self.layers[var_name].attrs[each_attr]
+            self.layers[var_name].attrs.pop(each_attr, None)
 
             # If attribute description is in the var's attributes, remove it
-            if error_name_desc in self.layers[var_name].attrs:
-                del self.layers[var_name].attrs[error_name_desc]
+            self.layers[var_name].attrs.pop(error_name_desc, None)
 
         # These attributes appear for all v* data variables of the granule,
         # capture it only once if it exists
@@ -1318,10 +1666,7 @@ class ITSCube:
                     each_attr not in self.layers and \
                     each_attr in self.ds[0][var_name].attrs:
                 self.layers[each_attr] = xr.DataArray(
-                    data=[
-                        ITSCube.get_data_var_attr(ds, url, var_name, each_attr, data_dtype=np.int32)
-                        for ds, url in zip(self.ds, self.urls)
-                    ],
+                    data=self.get_layer_attr_values((var_name, each_attr), np.int32),
                     coords=[mid_date_coord],
                     dims=[Coords.MID_DATE],
                     attrs={
@@ -1335,27 +1680,14 @@ class ITSCube:
                     self.layers[each_attr].attrs[DataVars.UNITS] = each_attr_units
 
             # Remove attribute if it made it into datacube as original variable attribute
-            if each_attr in self.layers[var_name].attrs:
-                del self.layers[var_name].attrs[each_attr]
+            self.layers[var_name].attrs.pop(each_attr, None)
 
-        if DataVars.FLAG_STABLE_SHIFT_DESCRIPTION in self.layers[var_name].attrs:
-            del self.layers[var_name].attrs[DataVars.FLAG_STABLE_SHIFT_DESCRIPTION]
+        self.layers[var_name].attrs.pop(DataVars.FLAG_STABLE_SHIFT_DESCRIPTION, None)
 
         # Create 'stable_shift' specific to the data variable,
         # for example, 'vx_stable_shift' for 'vx' data variable
         shift_var_name = _name_sep.join([var_name, DataVars.STABLE_SHIFT])
-        stable_shift_values = np.array(
-            [
-                ITSCube.get_data_var_attr(
-                    ds,
-                    url,
-                    var_name,
-                    DataVars.STABLE_SHIFT,
-                    DataVars.MISSING_VALUE
-                )
-                for ds, url in zip(self.ds, self.urls)
-            ]
-        )
+        stable_shift_values = self.get_layer_attr_values((var_name, DataVars.STABLE_SHIFT), np.float32)
 
         # Some of the granules have "stable_shift" attribute set to NaN:
         # set them to zero
@@ -1378,20 +1710,15 @@ class ITSCube:
         return_vars.append(shift_var_name)
 
         stable_shift_values = None
-        gc.collect()
 
-        if DataVars.STABLE_SHIFT in self.layers[var_name].attrs:
-            del self.layers[var_name].attrs[DataVars.STABLE_SHIFT]
+        self.layers[var_name].attrs.pop(DataVars.STABLE_SHIFT, None)
 
         # Create 'stable_shift_mask' and 'stable_shift_slow' specific to the data variable
         # (for example, 'vx_stable_shift_mask' for 'vx' data variable).
         for each_attr in [DataVars.STABLE_SHIFT_MASK, DataVars.STABLE_SHIFT_SLOW]:
             shift_var_name = _name_sep.join([var_name, each_attr])
             self.layers[shift_var_name] = xr.DataArray(
-                data=[
-                    ITSCube.get_data_var_attr(ds, url, var_name, each_attr, DataVars.MISSING_VALUE)
-                    for ds, url in zip(self.ds, self.urls)
-                ],
+                data=self.get_layer_attr_values((var_name, each_attr), np.float32),
                 coords=[mid_date_coord],
                 dims=[Coords.MID_DATE],
                 attrs={
@@ -1403,8 +1730,7 @@ class ITSCube:
             return_vars.append(shift_var_name)
 
             # If attribute is propagated as cube's vx attribute, delete it
-            if each_attr in self.layers[var_name].attrs:
-                del self.layers[var_name].attrs[each_attr]
+            self.layers[var_name].attrs.pop(each_attr, None)
 
         # Return names of new data variables - to be included into "encoding" settings
         # for writing to the file store.
@@ -1421,10 +1747,7 @@ class ITSCube:
         # Need to create new DR_TO_VR_FACTOR data variable
         attr_name = f'{var_name}{_name_sep}{DataVars.DR_TO_VR_FACTOR}'
 
-        attr_data = [
-            ITSCube.get_data_var_attr(ds, url, var_name, attr_name, DataVars.MISSING_BYTE)
-            for ds, url in zip(self.ds, self.urls)
-        ]
+        attr_data = self.get_layer_attr_values((var_name, attr_name), np.float32)
 
         self.layers[attr_name] = xr.DataArray(
             data=attr_data,
@@ -1438,11 +1761,9 @@ class ITSCube:
         )
 
         # Remove attributes from the "parent" variable
-        if DataVars.DR_TO_VR_FACTOR in self.layers[var_name].attrs:
-            del self.layers[var_name].attrs[DataVars.DR_TO_VR_FACTOR]
+        self.layers[var_name].attrs.pop(DataVars.DR_TO_VR_FACTOR, None)
 
-        if DataVars.DR_TO_VR_FACTOR_DESCRIPTION in self.layers[var_name].attrs:
-            del self.layers[var_name].attrs[DataVars.DR_TO_VR_FACTOR_DESCRIPTION]
+        self.layers[var_name].attrs.pop(DataVars.DR_TO_VR_FACTOR_DESCRIPTION, None)
 
         # Remove scale_factor and offset that come with original M11 and M12 data
         # if any
@@ -1467,6 +1788,123 @@ class ITSCube:
 
         self.layers[var_name].attrs[DataVars.GRID_MAPPING] = ds_grid_mapping_value
 
+    def get_grid_cells(self, x_values, y_values):
+        """
+        Locate cells of the layer within datacube grid. Layers share a few
+        distinct grids (granules are cropped to the same datacube extent),
+        so located cells are cached per grid for all layers and data variables.
+
+        Inputs:
+        =======
+        x_values: X coordinates of the layer.
+        y_values: Y coordinates of the layer.
+
+        Returns:
+        =======
+        Tuple of (datacube cells, layer cells) indices that correspond to
+        the same (y, x) grid cells.
+        """
+        key = (x_values.tobytes(), y_values.tobytes())
+
+        if key not in self.grid_cells:
+            x_index = pd.Index(self.grid_x).get_indexer(x_values)
+            y_index = pd.Index(self.grid_y).get_indexer(y_values)
+
+            self.grid_cells[key] = (
+                ITSCube.to_outer_index(y_index[y_index >= 0], x_index[x_index >= 0]),
+                ITSCube.to_outer_index(np.flatnonzero(y_index >= 0), np.flatnonzero(x_index >= 0))
+            )
+
+        return self.grid_cells[key]
+
+    @staticmethod
+    def to_outer_index(y_index, x_index):
+        """
+        Return index to select (y, x) cells of 2d array by provided 1d indices.
+        Contiguous ranges of indices, as is the case for aligned grids, are
+        converted to slices to avoid fancy indexing.
+        """
+        y_index, x_index = [
+            slice(each[0], each[-1] + 1) if len(each) and np.all(np.diff(each) == 1) else each
+            for each in [y_index, x_index]
+        ]
+
+        if isinstance(y_index, np.ndarray) and isinstance(x_index, np.ndarray):
+            return np.ix_(y_index, x_index)
+
+        return y_index, x_index
+
+    def stack_layers(self, var_names: list, mid_date_coord, get_layer_var=None):
+        """
+        Stack data variables of all layers into arrays pre-allocated for the
+        datacube grid. This is equivalent to concatenating the layers along
+        'mid_date' dimension and aligning the result to the datacube grid,
+        without per-layer alignment by xr.concat() and its temporary arrays.
+        Grid cells not covered by the layer are set to NaN.
+
+        Inputs:
+        =======
+        var_names: Names of the data variables to stack.
+        mid_date_coord: Middle date coordinate for collected data.
+        get_layer_var: Function to get data variable of the layer as
+            get_layer_var(ds, var_name). Default is ds[var_name].
+
+        Returns:
+        =======
+        Dictionary of xr.DataArray objects for each of the data variables.
+        """
+        layers = {}
+        for each_var in var_names:
+            layer_vars = [
+                ds[each_var] if get_layer_var is None else get_layer_var(ds, each_var)
+                for ds in self.ds
+            ]
+
+            data_dtype = np.result_type(*[each.dtype for each in layer_vars])
+            if not np.issubdtype(data_dtype, np.floating):
+                # Data type must be able to hold NaN for cells not covered by the layer
+                data_dtype = np.promote_types(data_dtype, np.float32)
+
+            data = np.full((len(layer_vars), len(self.grid_y), len(self.grid_x)), np.nan, dtype=data_dtype)
+
+            for index, each in enumerate(layer_vars):
+                cube_cells, layer_cells = self.get_grid_cells(each.x.values, each.y.values)
+                data[index][cube_cells] = each.transpose(Coords.Y, Coords.X).values[layer_cells]
+
+            layers[each_var] = xr.DataArray(
+                data=data,
+                coords=[mid_date_coord, self.grid_y, self.grid_x],
+                dims=[Coords.MID_DATE, Coords.Y, Coords.X],
+                attrs=copy.deepcopy(layer_vars[0].attrs)
+            )
+            layers[each_var].encoding = copy.deepcopy(layer_vars[0].encoding)
+
+        return layers
+
+    def release_layers_vars(self, var_names: list):
+        """
+        Delete data variables from all layers in place to free up memory.
+        This avoids re-building each of the layers by Dataset.drop_vars().
+
+        Inputs:
+        =======
+        var_names: Names of the data variables to delete. Layers that
+            don't have the variable are skipped.
+        """
+        for ds in self.ds:
+            for each_var in var_names:
+                if each_var in ds:
+                    del ds[each_var]
+
+    @staticmethod
+    def release_memory():
+        """
+        Return memory freed by the process back to the OS: glibc keeps freed
+        heap memory in its arenas otherwise. No-op if glibc is not available.
+        """
+        if LIBC is not None:
+            LIBC.malloc_trim(0)
+
     @staticmethod
     def show_memory_usage(msg: str = ''):
         """
@@ -1504,14 +1942,14 @@ class ITSCube:
         wrote_layers = True
 
         start_time = timeit.default_timer()
-        mid_date_coord = pd.Index(self.dates, name=Coords.MID_DATE)
+        mid_date_coord = pd.Index(self.dates[:self.num_dates], name=Coords.MID_DATE)
 
         self.layers = xr.Dataset(
             data_vars={DataVars.URL: ([Coords.MID_DATE], self.urls)},
             coords={
                 Coords.MID_DATE: (
                     Coords.MID_DATE,
-                    self.dates,
+                    mid_date_coord,
                     {
                         DataVars.STD_NAME: Coords.STD_NAME[Coords.MID_DATE],
                         DataVars.DESCRIPTION_ATTR: Coords.DESCRIPTION[Coords.MID_DATE]
@@ -1644,7 +2082,6 @@ class ITSCube:
                 }
             )
             self.land_ice_mask = None
-            gc.collect()
 
             self.floating_ice_mask = to_int_type(
                 self.floating_ice_mask,
@@ -1666,17 +2103,17 @@ class ITSCube:
                 }
             )
             self.floating_ice_mask = None
-            gc.collect()
 
         # ATTN: Assign one data variable at a time to avoid running out of memory.
         #       Delete each variable after it has been processed to free up the
         #       memory.
 
-        # Process 'v' (all formats have v variable - its attributes are inherited,
-        # so no need to set them manually)
-        v_layers = xr.concat([each_ds.v for each_ds in self.ds], mid_date_coord)
+        # Stack 'v' and 'v[xy]' data variables, which all formats have, into
+        # pre-allocated arrays
+        v_layers = self.stack_layers(ITSCube.STACK_LAYERS_VARS, mid_date_coord)
 
-        self.layers[DataVars.V] = v_layers
+        # Process 'v' (its attributes are inherited, so no need to set them manually)
+        self.layers[DataVars.V] = v_layers[DataVars.V]
         self.layers[DataVars.V].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[DataVars.V]
         new_v_vars = [DataVars.V]
 
@@ -1689,16 +2126,13 @@ class ITSCube:
         # set with the same value
         ds_grid_mapping_value = DataVars.MAPPING
 
-        # Drop data variable as we don't need it anymore - free up memory
-        self.ds = [each.drop_vars(DataVars.V) for each in self.ds]
-        del v_layers
-        gc.collect()
 
         # Process 'v_error'
-        self.layers[DataVars.V_ERROR] = xr.concat(
-            [self.get_data_var(ds, DataVars.V_ERROR) for ds in self.ds],
-            mid_date_coord
-        )
+        self.layers[DataVars.V_ERROR] = self.stack_layers(
+            [DataVars.V_ERROR],
+            mid_date_coord,
+            self.get_data_var
+        )[DataVars.V_ERROR]
         self.layers[DataVars.V_ERROR].attrs[DataVars.STD_NAME] = DataVars.NAME[DataVars.V_ERROR]
         self.layers[DataVars.V_ERROR].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[DataVars.V_ERROR]
         self.layers[DataVars.V_ERROR].attrs[DataVars.UNITS] = DataVars.M_Y_UNITS
@@ -1708,26 +2142,24 @@ class ITSCube:
         self.set_grid_mapping_attr(DataVars.V_ERROR, ds_grid_mapping_value)
 
         # Drop data variable as we don't need it anymore - free up memory
-        # Drop only from datasets that have it
-        self.ds = [ds.drop_vars(DataVars.V_ERROR) if DataVars.V_ERROR in ds else ds for ds in self.ds]
-        gc.collect()
+        self.release_layers_vars([DataVars.V_ERROR])
 
         # Process 'v[xy]' data variables and their attributes
         for each_var in [DataVars.VX, DataVars.VY]:
-            self.layers[each_var] = xr.concat([ds[each_var] for ds in self.ds], mid_date_coord)
+            self.layers[each_var] = v_layers[each_var]
             self.layers[each_var].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[each_var]
             new_v_vars.append(each_var)
             new_v_vars.extend(self.process_v_attributes(each_var, mid_date_coord))
 
             self.set_grid_mapping_attr(each_var, ds_grid_mapping_value)
 
-            # Drop data variable as we don't need it anymore - free up memory
-            self.ds = [ds.drop_vars(each_var) if each_var in ds else ds for ds in self.ds]
-            gc.collect()
+        # Drop stacked data variables as we don't need them anymore - free up memory
+        self.release_layers_vars(ITSCube.STACK_LAYERS_VARS)
+        del v_layers
 
         # Process 'v[ar]' data variables and their attributes
         for each_var in [DataVars.VA, DataVars.VR]:
-            self.layers[each_var] = xr.concat([self.get_data_var(ds, each_var) for ds in self.ds], mid_date_coord)
+            self.layers[each_var] = self.stack_layers([each_var], mid_date_coord, self.get_data_var)[each_var]
             self.layers[each_var].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[each_var]
             new_v_vars.append(each_var)
             new_v_vars.extend(self.process_v_attributes(each_var, mid_date_coord))
@@ -1735,13 +2167,12 @@ class ITSCube:
             self.set_grid_mapping_attr(each_var, ds_grid_mapping_value)
 
             # Drop data variable as we don't need it anymore - free up memory
-            self.ds = [ds.drop_vars(each_var) if each_var in ds else ds for ds in self.ds]
-            gc.collect()
+            self.release_layers_vars([each_var])
 
         new_vars_zero_missing_value = []
         # Process 'M1[12]' data variables of radar format, if any, and their attributes
         for each_var in [DataVars.M11, DataVars.M12]:
-            self.layers[each_var] = xr.concat([self.get_data_var(ds, each_var) for ds in self.ds], mid_date_coord)
+            self.layers[each_var] = self.stack_layers([each_var], mid_date_coord, self.get_data_var)[each_var]
             self.layers[each_var].attrs[DataVars.STD_NAME] = DataVars.NAME[each_var]
             self.layers[each_var].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[each_var]
             self.layers[each_var].attrs[DataVars.UNITS] = DataVars.PIXEL_PER_M_YEAR
@@ -1751,19 +2182,19 @@ class ITSCube:
             self.set_grid_mapping_attr(each_var, ds_grid_mapping_value)
 
             # Drop data variable as we don't need it anymore - free up memory
-            self.ds = [ds.drop_vars(each_var) if each_var in ds else ds for ds in self.ds]
-            gc.collect()
+            self.release_layers_vars([each_var])
 
         # Process chip_size_height: dtype=ushort
         # Optical legacy granules might not have chip_size_height set, use
         # chip_size_width instead
-        self.layers[DataVars.CHIP_SIZE_HEIGHT] = xr.concat([
-                ds.chip_size_height if
-                np.ma.masked_equal(ds.chip_size_height.values, ITSCube.CHIP_SIZE_HEIGHT_NO_VALUE).count() != 0 else
-                ds.chip_size_width for ds in self.ds
-            ],
-            mid_date_coord
-        )
+        concat_ind = [ind for ind, ds in enumerate(self.ds) if np.ma.masked_equal(ds.chip_size_height.values, ITSCube.CHIP_SIZE_HEIGHT_NO_VALUE).count() == 0]
+        use_width_ids = set(id(self.ds[ind]) for ind in concat_ind)
+
+        self.layers[DataVars.CHIP_SIZE_HEIGHT] = self.stack_layers(
+            [DataVars.CHIP_SIZE_HEIGHT],
+            mid_date_coord,
+            lambda ds, var_name: ds.chip_size_width if id(ds) in use_width_ids else ds[var_name]
+        )[DataVars.CHIP_SIZE_HEIGHT]
         self.layers[DataVars.CHIP_SIZE_HEIGHT].attrs[DataVars.CHIP_SIZE_COORDS] = \
             DataVars.DESCRIPTION[DataVars.CHIP_SIZE_COORDS]
         self.layers[DataVars.CHIP_SIZE_HEIGHT].attrs[DataVars.DESCRIPTION_ATTR] = \
@@ -1772,27 +2203,18 @@ class ITSCube:
         self.set_grid_mapping_attr(DataVars.CHIP_SIZE_HEIGHT, ds_grid_mapping_value)
 
         # Report if used chip_size_width in place of chip_size_height
-        concat_ind = [ind for ind, ds in enumerate(self.ds) if np.ma.masked_equal(ds.chip_size_height.values, ITSCube.CHIP_SIZE_HEIGHT_NO_VALUE).count() == 0]
         for each in concat_ind:
             self.logger.warning(f'Using chip_size_width in place of chip_size_height for {self.urls[each]}')
 
-        # Drop data variable as we don't need it anymore - free up memory
-        self.ds = [ds.drop_vars(DataVars.CHIP_SIZE_HEIGHT) for ds in self.ds]
-        gc.collect()
-
         # Process chip_size_width: dtype=ushort
-        self.layers[DataVars.CHIP_SIZE_WIDTH] = xr.concat([ds.chip_size_width for ds in self.ds], mid_date_coord)
+        self.layers[DataVars.CHIP_SIZE_WIDTH] = self.stack_layers([DataVars.CHIP_SIZE_WIDTH], mid_date_coord)[DataVars.CHIP_SIZE_WIDTH]
         self.layers[DataVars.CHIP_SIZE_WIDTH].attrs[DataVars.CHIP_SIZE_COORDS] = DataVars.DESCRIPTION[DataVars.CHIP_SIZE_COORDS]
         self.layers[DataVars.CHIP_SIZE_WIDTH].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[DataVars.CHIP_SIZE_WIDTH]
 
         self.set_grid_mapping_attr(DataVars.CHIP_SIZE_WIDTH, ds_grid_mapping_value)
 
-        # Drop data variable as we don't need it anymore - free up memory
-        self.ds = [ds.drop_vars(DataVars.CHIP_SIZE_WIDTH) for ds in self.ds]
-        gc.collect()
-
         # Process interp_mask: dtype=ubyte
-        self.layers[DataVars.INTERP_MASK] = xr.concat([ds.interp_mask for ds in self.ds], mid_date_coord)
+        self.layers[DataVars.INTERP_MASK] = self.stack_layers([DataVars.INTERP_MASK], mid_date_coord)[DataVars.INTERP_MASK]
         self.layers[DataVars.INTERP_MASK].attrs[DataVars.STD_NAME] = DataVars.NAME[DataVars.INTERP_MASK]
         self.layers[DataVars.INTERP_MASK].attrs[DataVars.DESCRIPTION_ATTR] = DataVars.DESCRIPTION[DataVars.INTERP_MASK]
         self.layers[DataVars.INTERP_MASK].attrs[BinaryFlag.VALUES_ATTR] = BinaryFlag.VALUES
@@ -1800,9 +2222,11 @@ class ITSCube:
 
         self.set_grid_mapping_attr(DataVars.INTERP_MASK, ds_grid_mapping_value)
 
-        # Drop data variable as we don't need it anymore - free up memory
-        self.ds = [ds.drop_vars(DataVars.INTERP_MASK) for ds in self.ds]
-        gc.collect()
+        # All data variables have been collected from the layers - release
+        # the layers along with their remaining (chip_size_*, interp_mask and
+        # 2-d) variables at once
+        self.ds = []
+        self.grid_cells = {}
 
         for each in DataVars.ImgPairInfo.ALL:
             # Add new variables that correspond to attributes of 'img_pair_info'
@@ -1811,15 +2235,18 @@ class ITSCube:
             if each in DataVars.ImgPairInfo.ALL_DTYPE:
                 each_dtype = DataVars.ImgPairInfo.ALL_DTYPE[each]
 
+            if each_dtype is np.float32:
+                each_data = np.fromiter(
+                    (attrs[each] for attrs in self.layer_attrs),
+                    dtype=each_dtype,
+                    count=len(self.layer_attrs)
+                )
+
+            else:
+                each_data = [attrs[each] for attrs in self.layer_attrs]
+
             self.layers[each] = xr.DataArray(
-                data=[ITSCube.get_data_var_attr(
-                    ds,
-                    url,
-                    DataVars.ImgPairInfo.NAME,
-                    each,
-                    to_date=DataVars.ImgPairInfo.CONVERT_TO_DATE[each],
-                    data_dtype=each_dtype
-                ) for ds, url in zip(self.ds, self.urls)],
+                data=each_data,
                 coords=[mid_date_coord],
                 dims=[Coords.MID_DATE],
                 attrs={
@@ -1834,7 +2261,7 @@ class ITSCube:
 
         # Add new variable that corresponds to autoRIFT_software_version
         self.layers[DataVars.AUTORIFT_SOFTWARE_VERSION] = xr.DataArray(
-            data=[ds.attrs[DataVars.AUTORIFT_SOFTWARE_VERSION] for ds in self.ds],
+            data=[attrs[DataVars.AUTORIFT_SOFTWARE_VERSION] for attrs in self.layer_attrs],
             coords=[mid_date_coord],
             dims=[Coords.MID_DATE],
             attrs={
@@ -1854,7 +2281,7 @@ class ITSCube:
         self.logger.info(f"Combined {len(self.urls)} layers (took {time_delta} seconds)")
         # ITSCube.show_memory_usage('after combining layers')
 
-        compressor = zarr.Blosc(cname="zlib", clevel=2, shuffle=1)
+        compressor = ITSCube.ZARR_COMPRESSOR
         compression = {"compressor": compressor}
 
         start_time = timeit.default_timer()
@@ -2088,23 +2515,35 @@ class ITSCube:
                 self.layers[each].encoding = {}
                 encoding_settings.setdefault(each, {})[Output.CHUNKS_ATTR] = (chunking_settings_1d)
 
-                if Output.FILL_VALUE_ATTR in self.layers[each].attrs:
-                    del self.layers[each].attrs[Output.FILL_VALUE_ATTR]
+                self.layers[each].attrs.pop(Output.FILL_VALUE_ATTR, None)
 
                 # logging.info(f'Encoding for {each}: {encoding_settings[each]}')
                 # logging.info(f'each.attrs for {each}: {self.layers[each].attrs}')
                 # logging.info(f'each.encoding for {each}: {self.layers[each].encoding}')
 
+            # Use the same compressor for all variables of the store rather than
+            # relying on Zarr's default for the variables that are not set above
+            for each in self.layers.variables:
+                encoding_settings.setdefault(each, {}).setdefault(Output.COMPRESSOR_ATTR, compressor)
+
             self.logger.info(f"Encoding writing to Zarr: {encoding_settings}")
             # self.logger.info(f"Data variables to Zarr:   {json.dumps(list(self.layers.keys()), indent=4)}")
 
             # This is first write, create Zarr store
             # self.layers.to_zarr(output_dir, encoding=encoding_settings, consolidated=True)
-            self.layers.to_zarr(output_dir, encoding=encoding_settings, consolidated=True)
+            # Write blocks of data variables with threaded Dask scheduler
+            # regardless of the scheduler used to read the granules
+            self.chunk_layers_for_write()
+            self.layers.to_zarr(
+                output_dir,
+                encoding=encoding_settings,
+                consolidated=True,
+                compute=False
+            ).compute(scheduler='threads', num_workers=ITSCube.NUM_THREADS)
 
         else:
             # Append layers to existing Zarr store
-            self.layers.to_zarr(output_dir, append_dim=Coords.MID_DATE, consolidated=True)
+            self.append_layers(output_dir)
 
         time_delta = timeit.default_timer() - start_time
         self.logger.info(f"Wrote {len(self.urls)} layers to {output_dir} (took {time_delta} seconds)")
@@ -2117,6 +2556,103 @@ class ITSCube:
         # Return a flag if any layers were written to the store
         return wrote_layers
 
+    def chunk_layers_for_write(self):
+        """
+        Split 3d data variables of the layers into spatial blocks of
+        ITSCube.WRITE_X_Y_CHUNK_VALUE size, so they are encoded and written
+        to the Zarr store one block at a time. Each block covers whole
+        Zarr chunks of the store.
+        """
+        for each, each_var in list(self.layers.data_vars.items()):
+            if each_var.dims == (Coords.MID_DATE, Coords.Y, Coords.X):
+                self.layers[each] = each_var.chunk({
+                    Coords.Y: ITSCube.WRITE_X_Y_CHUNK_VALUE,
+                    Coords.X: ITSCube.WRITE_X_Y_CHUNK_VALUE
+                })
+
+    def append_layers(self, output_dir: str):
+        """
+        Append layers to existing Zarr store. Grow all data variables along
+        'mid_date' dimension first, then write new layers as a region of the
+        store. This avoids xarray's append path re-opening and resizing the
+        store per data variable.
+
+        Inputs:
+        =======
+        output_dir: Zarr store to append layers to.
+        """
+        zarr_group = zarr.open(output_dir, mode='r+')
+
+        # Number of layers in the store before the append
+        start_index = zarr_group[Coords.MID_DATE].shape[0]
+        end_index = start_index + len(self.layers[Coords.MID_DATE])
+
+        # Grow all data variables that are indexed by 'mid_date'
+        for _, each_array in zarr_group.arrays():
+            each_dims = each_array.attrs.get(ITSCube.ZARR_DIMS_ATTR, [])
+
+            if Coords.MID_DATE in each_dims:
+                new_shape = list(each_array.shape)
+                new_shape[each_dims.index(Coords.MID_DATE)] = end_index
+                each_array.resize(*new_shape)
+
+        # Flags of v[xyar] data variables are created only if the first granule of
+        # the batch has them (see process_v_attributes()): region writes can't
+        # create new variables, so create missing flags in the store for all
+        # layers first. Existing layers don't have values for the flags.
+        for each in ITSCube.V_LAYER_FLAGS:
+            if each in self.layers and each not in zarr_group:
+                ITSCube.create_layer_flag(zarr_group, each, end_index, self.layers[each].attrs)
+
+        # Region writes can't include variables that are not indexed by 'mid_date'
+        # (such as 'x' and 'y' coordinates): these are already in the store
+        drop_vars = [
+            each for each, each_var in self.layers.variables.items()
+            if Coords.MID_DATE not in each_var.dims
+        ]
+
+        # ATTN: Don't use consolidated metadata of the store as it still has
+        # original sizes of the data variables
+        self.chunk_layers_for_write()
+        self.layers.drop_vars(drop_vars).to_zarr(
+            output_dir,
+            region={Coords.MID_DATE: slice(start_index, end_index)},
+            consolidated=False,
+            compute=False
+        ).compute(scheduler='threads', num_workers=ITSCube.NUM_THREADS)
+
+        # Store consolidated metadata once all data variables have been written
+        zarr.consolidate_metadata(output_dir)
+
+    @staticmethod
+    def create_layer_flag(zarr_group: zarr.Group, var_name: str, num_layers: int, attrs: dict):
+        """
+        Create layer flag data variable in the Zarr store with the same storage
+        settings as the first write uses for the flags. All values are missing:
+        use maximum value of the flag's data type as missing value.
+
+        Inputs:
+        =======
+        zarr_group: Zarr store to create data variable in.
+        var_name: Name of the flag data variable.
+        num_layers: Number of layers in the store.
+        attrs: Attributes of the flag data variable.
+        """
+        dtype_value = DataVars.INT_TYPE[var_name]
+
+        flag_array = zarr_group.full(
+            var_name,
+            fill_value=np.iinfo(dtype_value).max,
+            shape=(num_layers,),
+            # Use the same chunking as for all other 1d data variables of the store
+            chunks=zarr_group[Coords.MID_DATE].chunks,
+            dtype=dtype_value,
+            compressor=ITSCube.ZARR_COMPRESSOR
+        )
+
+        flag_array.attrs.update(attrs)
+        flag_array.attrs[ITSCube.ZARR_DIMS_ATTR] = [Coords.MID_DATE]
+
     def format_stats(self):
         """
         Format statistics of the run. Don't display statistics if using
@@ -2137,55 +2673,132 @@ class ITSCube:
 
     def read_dataset(self, url: str):
         """
-        Read Dataset from the file and pre-process for the cube layer.
+        Read Dataset from the local file and pre-process for the cube layer.
         """
-        with xr.open_dataset(url) as ds:
+        with ITSCube.open_granule(url) as ds:
             return self.preprocess_dataset(ds, url)
 
-    def read_s3_dataset(
-            self,
+    @staticmethod
+    def s3_path(each_url: str):
+        """
+        Convert granule's URL to its location within S3 bucket.
+        """
+        s3_path = each_url.replace(ITSCube.HTTP_PREFIX, ITSCube.S3_PREFIX)
+        return s3_path.replace(ITSCube.PATH_URL, '')
+
+    @staticmethod
+    def read_s3_bytes(
             each_url: str,
             s3: s3fs.S3FileSystem,
             total_retries: int = 5,
             num_seconds: int = 15
     ):
         """
-        Read Dataset from the S3 bucket and pre-process it for the cube layer.
-        Return re-tried exceptions messages, if any, and cube layer information.
+        Read the whole granule from the S3 bucket into memory with a single GET
+        request. Return re-tried exceptions messages, if any, and in-memory
+        file object for the granule.
 
         each_url: Granule S3 URL.
         s3: s3fs.S3FileSystem object to access the granule from.
         total_retries: Number of retries in a case of exception
         num_seconds: Number of seconds to sleep between retries.
         """
-        s3_path = each_url.replace(ITSCube.HTTP_PREFIX, ITSCube.S3_PREFIX)
-        s3_path = s3_path.replace(ITSCube.PATH_URL, '')
-
-        num_retries = 0
-        got_granule = False
+        s3_path = ITSCube.s3_path(each_url)
 
         exception_info = []
 
-        while not got_granule and num_retries < total_retries:
-            num_retries += 1
+        for num_retries in range(1, total_retries + 1):
             try:
-                with s3.open(s3_path, mode='rb') as fhandle:
-                    with xr.open_dataset(fhandle, engine=ITSCube.NC_ENGINE) as ds:
-                        results = self.preprocess_dataset(ds, each_url)
-                        return exception_info, *results
-
-            except RuntimeError:
-                # Re-raise the exception
-                raise
+                return exception_info, io.BytesIO(s3.cat(s3_path))
 
             except:
-                # Other types of exceptions (like botocore.exceptions.ResponseStreamingError)
+                # Any type of exceptions (like botocore.exceptions.ResponseStreamingError)
                 exception_info.append(f'Got exception reading {s3_path}: {sys.exc_info()}')
                 if num_retries < total_retries:
                     # Sleep if it's not last attempt
                     exception_info.append(f'Sleeping for {num_seconds} seconds...')
                     time.sleep(num_seconds)
 
+        raise RuntimeError(f'Failed to read {s3_path} after {total_retries} retries: {exception_info}')
+
+    @staticmethod
+    def prefetch_s3_bytes(urls: list, s3: s3fs.S3FileSystem, concurrency: int):
+        """
+        Generator to download granules concurrently: keep up to "concurrency"
+        granules downloading ahead of the one currently being consumed by
+        the caller.
+
+        Yields a tuple of (granule URL, re-tried exceptions messages, in-memory
+        file object) in the order of provided URLs.
+        """
+        urls = iter(urls)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = collections.deque(
+                (each_url, executor.submit(ITSCube.read_s3_bytes, each_url, s3))
+                for each_url in itertools.islice(urls, concurrency)
+            )
+
+            while len(pending):
+                each_url, each_future = pending.popleft()
+
+                # Keep "concurrency" downloads in flight
+                next_url = next(urls, None)
+                if next_url is not None:
+                    pending.append((next_url, executor.submit(ITSCube.read_s3_bytes, next_url, s3)))
+
+                yield each_url, *each_future.result()
+
+    @staticmethod
+    def open_granule(fhandle):
+        """
+        Open granule from the file object or local path with h5netcdf engine using
+        ITSCube.H5_DRIVER_KWDS settings for the underlying h5py.File.
+        """
+        h5file = h5netcdf.File(fhandle, mode='r', phony_dims=ITSCube.H5_PHONY_DIMS, **ITSCube.H5_DRIVER_KWDS)
+        return xr.open_dataset(xr.backends.H5NetCDFStore(h5file))
+
+    @staticmethod
+    def get_s3():
+        """
+        Return S3 file system object for the current thread. It's created
+        on first use within each of the Dask workers instead of being pickled
+        along with each of the parallel tasks.
+        """
+        if not hasattr(ITSCube.S3_THREAD_LOCAL, 's3'):
+            ITSCube.S3_THREAD_LOCAL.s3 = s3fs.S3FileSystem(
+                config_kwargs={
+                    'max_pool_connections': max(ITSCube.S3_MAX_POOL_CONNECTIONS, ITSCube.NUM_PREFETCH_GRANULES)
+                }
+            )
+
+        return ITSCube.S3_THREAD_LOCAL.s3
+
+    def read_s3_datasets(self, urls: list, s3: s3fs.S3FileSystem = None):
+        """
+        Read Datasets from the S3 bucket and pre-process them for the cube layers.
+        Granules are downloaded concurrently (up to ITSCube.NUM_PREFETCH_GRANULES
+        at a time) while already downloaded granules are pre-processed.
+
+        Return a list of re-tried exceptions messages, if any, and cube layer
+        information for each of the granules.
+
+        urls: Granules S3 URLs.
+        s3: s3fs.S3FileSystem object to access the granules from. If not
+            provided, S3 file system of the current thread is used.
+        """
+        if s3 is None:
+            s3 = ITSCube.get_s3()
+
+        results = []
+
+        for each_url, exception_info, fhandle in ITSCube.prefetch_s3_bytes(urls, s3, ITSCube.NUM_PREFETCH_GRANULES):
+            with fhandle:
+                with ITSCube.open_granule(fhandle) as ds:
+                    results.append((exception_info, self.preprocess_dataset(ds, each_url)))
+
+        return results
+
     @staticmethod
     def plot(cube, variable, boundaries: tuple = None):
         """
@@ -2412,6 +3025,25 @@ if __name__ == '__main__':
         default=8,
         help='Number of Dask workers to use for parallel processing [%(default)d].'
     )
+    parser.add_argument(
+        '--daskScheduler',
+        type=str,
+        choices=ITSCube.DASK_SCHEDULERS,
+        default=ITSCube.DASK_SCHEDULER,
+        help='Dask scheduler to use for parallel processing [%(default)s].'
+    )
+    parser.add_argument(
+        '--granulesPerTask',
+        type=int,
+        default=ITSCube.NUM_GRANULES_PER_TASK,
+        help='Number of granules to read and pre-process within each of the Dask tasks [%(default)d].'
+    )
+    parser.add_argument(
+        '--prefetchGranules',
+        type=int,
+        default=ITSCube.NUM_PREFETCH_GRANULES,
+        help='Number of granules to download concurrently ahead of their pre-processing within each of the Dask tasks [%(default)d].'
+    )
     parser.add_argument(
         '-r', '--removeExistingCube',
         action='store_true',
@@ -2556,6 +3188,9 @@ if __name__ == '__main__':
         raise RuntimeError(f'Output Zarr store is expected to have {FileExtension.ZARR} extension, got {args.outputStore}')
 
     ITSCube.NUM_THREADS = args.threads
+    ITSCube.DASK_SCHEDULER = args.daskScheduler
+    ITSCube.NUM_GRANULES_PER_TASK = args.granulesPerTask
+    ITSCube.NUM_PREFETCH_GRANULES = args.prefetchGranules
     ITSCube.NUM_GRANULES_TO_WRITE = args.chunks
     ITSCube.CELL_SIZE = args.gridCellSize
     ITSCube.PATH_URL = args.pathURLToken
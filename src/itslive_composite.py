@@ -1511,7 +1511,12 @@ class SensorExcludeFilter:
         """
         # Map each sensor to its mission group
         # Use homogeneous type as keys (numba allows for key values of the same type only)
-        return np.array([MissionSensor.GROUPS_MISSIONS[str(x)] for x in sensors])
+        # There are only a few unique sensors within the cube: look up mission
+        # group for each of the unique sensors only, and expand it to all layers
+        unique_sensors, unique_index = np.unique(sensors, return_inverse=True)
+        unique_groups = np.array([MissionSensor.GROUPS_MISSIONS[str(x)] for x in unique_sensors])
+
+        return unique_groups[unique_index]
 
     @staticmethod
     def identify_sensor_groups(sensors: list):
@@ -1,8 +1,9 @@
 import boto3
+from functools import lru_cache
+import io
 import json
 import requests
 import pyproj
-import numpy as np
 import os
 import logging
 from rtree import index
@@ -15,6 +16,13 @@ from grid import Bounds
 import boto3
 from rtree import index
 
+try:
+    # Use faster JSON parser for searchAPI responses if it's available
+    import orjson as _json
+
+except ImportError:
+    _json = json
+
 BASE_URL = 'https://nsidc.org/apps/itslive-search/velocities/urls'
 # BASE_URL = 'https://staging.nsidc.org/apps/itslive-search/velocities/urls'
 
@@ -27,6 +35,13 @@ _AWS_COPY_SLEEP_SECONDS = 60
 # An error generated by AWS when PUT/GET request rate exceeds 3500
 _AWS_SLOW_DOWN_ERROR = "An error occurred (SlowDown) when calling"
 
+# Size of the chunk (in bytes) to read searchAPI streamed response with
+_RESPONSE_CHUNK_SIZE = 1024*1024
+
+# Session to re-use connections to searchAPI across requests and their retries
+_SESSION = requests.Session()
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
 
 def get_min_lon_lat_max_lon_lat(coordinates: list):
     """
@@ -157,24 +172,41 @@ def s3_copy_using_subprocess(command_line: list, env_copy: dict, is_quiet: bool
         raise RuntimeError(f"Failed to invoke {' '.join(command_line)} with command.returncode={command_return.returncode}")
 
 
+@lru_cache(maxsize=64)
+def _get_transformer(proj1, proj2):
+    """Get transformer from proj1 to proj2 (EPSG num). Transformers are cached
+    as their initialization is much more expensive than the transformation."""
+    return pyproj.Transformer.from_crs(f"EPSG:{proj1}", f"EPSG:{proj2}", always_xy=True)  # ensure lonlat order
+
+
 def transform_coord(proj1, proj2, lon, lat):
     """Transform coordinates from proj1 to proj2 (EPSG num)."""
-    # Set full EPSG projection strings
-    proj1 = pyproj.Proj("+init=EPSG:"+proj1)
-    proj2 = pyproj.Proj("+init=EPSG:"+proj2)
-    # Convert coordinates
-    return pyproj.transform(proj1, proj2, lon, lat)
+    return _get_transformer(proj1, proj2).transform(lon, lat)
+
+
+def format_search_params(params: dict, **kwargs):
+    """
+    Format searchAPI request parameters: each value is passed as its string
+    representation with all single quotes removed (so a list is passed as "[a, b]").
+
+    params: request parameters
+    kwargs: additional request parameters
+    """
+    return {
+        each_key: str(each_value).replace("'", "")
+        for each_key, each_value in {**params, **kwargs}.items()
+    }
 
 
 def get_granule_urls(params):
     # Allow for longer query time from searchAPI: 10 minutes
-    resp = requests.get(BASE_URL, params=params, verify=False, timeout=500)
+    resp = _SESSION.get(BASE_URL, params=params, verify=False, timeout=500)
     return resp.json()
 
 
 def get_granule_urls_compressed(params, total_retries=1, num_seconds=30):
     """
-    Request granules URLs with ZIP compression enabled, save the stream to the ZIP file,
+    Request granules URLs with ZIP compression enabled, collect the stream in memory,
     and retrieve JSON information from the archive.
 
     params: request parameters
@@ -183,28 +215,15 @@ def get_granule_urls_compressed(params, total_retries=1, num_seconds=30):
     num_seconds: number of seconds to sleep between retries to query searchAPI.
                     Default is 30 seconds.
     """
-    # Format request URL:
-    url = f'{BASE_URL}?'
-    for each_key, each_value in params.items():
-        url += f'{each_key}={each_value}&'
-
-    # Add compression option
-    url += 'compressed=true&'
-
-    # Add requested granules version (TODO: should be configurable on startup?)
-    url += 'version=2'
-
-    # Get rid of all single quotes if any in URL
-    url = url.replace("'", "")
+    # Format request parameters with compression option and
+    # requested granules version (TODO: should be configurable on startup?)
+    search_params = format_search_params(params, compressed='true', version=2)
 
     num_retries = 0
     got_granules = False
     data = []
 
-    # Save response to local file:
-    local_path = 'searchAPI_urls.json.zip'
-
-    logging.info(f'Submitting searchAPI request with url={url}')
+    logging.info(f'Submitting searchAPI request with params={search_params}')
 
     while not got_granules and num_retries < total_retries:
         # Get list of granules:
@@ -212,20 +231,24 @@ def get_granule_urls_compressed(params, total_retries=1, num_seconds=30):
             logging.info(f"Getting granules from searchAPI: #{num_retries+1} attempt")
             num_retries += 1
 
-            resp = requests.get(url, stream=True, timeout=500)
+            resp = _SESSION.get(BASE_URL, params=search_params, stream=True, timeout=500)
 
-            logging.info(f'Saving searchAPI response to {local_path}')
-            with open(local_path, 'wb') as fh:
-                for chunk in resp.iter_content(10240, decode_unicode=False):
-                    _ = fh.write(chunk)
+            # Collect the response in memory: no need to write it to the local file
+            # to unzip it
+            zip_buffer = io.BytesIO()
+            for chunk in resp.iter_content(_RESPONSE_CHUNK_SIZE, decode_unicode=False):
+                _ = zip_buffer.write(chunk)
 
-            # Unzip the file
-            with zipfile.ZipFile(local_path, 'r') as fh:
+            logging.info(f'Got searchAPI response of {zip_buffer.tell()} bytes')
+
+            # Unzip the response
+            zip_buffer.seek(0)
+            with zipfile.ZipFile(zip_buffer, 'r') as fh:
                 zip_json_file = fh.namelist()[0]
                 logging.info(f'Extracting {zip_json_file}')
 
                 with fh.open(zip_json_file) as fh_json:
-                    data = json.load(fh_json)
+                    data = _json.loads(fh_json.read())
 
                     got_granules = True
 
@@ -238,13 +261,6 @@ def get_granule_urls_compressed(params, total_retries=1, num_seconds=30):
                 logging.info(f'Sleeping between searchAPI attempts for {num_seconds} seconds...')
                 time.sleep(num_seconds)
 
-        finally:
-            # Clean up local file
-            if os.path.exists(local_path):
-                # Remove local file
-                logging.info(f'Removing {local_path}')
-                os.unlink(local_path)
-
     if not got_granules:
         raise RuntimeError("Failed to get granules from searchAPI.")
 
@@ -261,27 +277,17 @@ def get_granule_urls_streamed(params, total_retries=1, num_seconds=30):
     num_seconds: number of seconds to sleep between retries to query searchAPI.
                     Default is 30 seconds.
     """
-    token = ']['
-
-    # Format request URL:
-    url = f'{BASE_URL}?'
-    for each_key, each_value in params.items():
-        url += f'{each_key}={each_value}&'
+    token = b']['
 
-    # Add requested granules version (TODO: should be configurable on startup?)
-    url += 'version=2'
-
-    # Get rid of all single quotes if any in URL
-    url = url.replace("'", "")
+    # Format request parameters with requested granules version
+    # (TODO: should be configurable on startup?)
+    search_params = format_search_params(params, version=2)
 
     num_retries = 0
     got_granules = False
     data = []
 
-    # Save response to local file:
-    local_path = 'searchAPI_urls.json'
-
-    logging.info(f'Submitting searchAPI request with url={url}')
+    logging.info(f'Submitting searchAPI request with params={search_params}')
 
     while not got_granules and num_retries < total_retries:
         # Get list of granules:
@@ -289,27 +295,26 @@ def get_granule_urls_streamed(params, total_retries=1, num_seconds=30):
             logging.info(f"Getting granules from searchAPI: #{num_retries+1} attempt")
             num_retries += 1
 
-            resp = requests.get(url, stream=True, timeout=500)
+            resp = _SESSION.get(BASE_URL, params=search_params, stream=True, timeout=500)
 
-            logging.info(f'Saving searchAPI response to {local_path}')
-            with open(local_path, 'a') as fh:
-                for chunk in resp.iter_content(10240, decode_unicode=True):
-                    _ = fh.write(chunk)
+            # Collect raw bytes of the response in memory, decode them only once
+            # when parsing JSON
+            data_buffer = io.BytesIO()
+            for chunk in resp.iter_content(_RESPONSE_CHUNK_SIZE, decode_unicode=False):
+                _ = data_buffer.write(chunk)
 
-            # Read data from local file
-            data = ''
-            with open(local_path) as fh:
-                data = fh.readline()
+            data = data_buffer.getvalue()
+            data_buffer = None
 
             # if multiple json strings are returned,  then possible to see '][' within
             # the string, replace it by ','
             if token in data:
-                logging.info('Got multiple json variables within the same string (len(data)={len(data)})')
-                data = data.replace(token, ',')
+                logging.info(f'Got multiple json variables within the same string (len(data)={len(data)})')
+                data = data.replace(token, b',')
 
-                logging.info('Merged multiple json variables into one list (len(data)={len(data)})')
+                logging.info(f'Merged multiple json variables into one list (len(data)={len(data)})')
 
-            data = json.loads(data)
+            data = _json.loads(data)
             got_granules = True
 
         except:
@@ -321,13 +326,6 @@ def get_granule_urls_streamed(params, total_retries=1, num_seconds=30):
                 logging.info(f'Sleeping between searchAPI attempts for {num_seconds} seconds...')
                 time.sleep(num_seconds)
 
-        finally:
-            # Clean up local file
-            if os.path.exists(local_path):
-                # Remove local file
-                logging.info(f'Removing {local_path}')
-                os.unlink(local_path)
-
     if not got_granules:
         raise RuntimeError("Failed to get granules from searchAPI.")
 
@@ -345,11 +343,11 @@ def point_to_prefix(lat: float, lon: float, dir_path: str = None) -> str:
     NShemi_str = 'N' if lat >= 0.0 else 'S'
     EWhemi_str = 'E' if lon >= 0.0 else 'W'
 
-    outlat = int(10*np.trunc(np.abs(lat/10.0)))
+    outlat = int(abs(lat)) // 10 * 10
     if outlat == 90:  # if you are exactly at a pole, put in lat = 80 bin
         outlat = 80
 
-    outlon = int(10*np.trunc(np.abs(lon/10.0)))
+    outlon = int(abs(lon)) // 10 * 10
 
     if outlon >= 180:  # if you are at the dateline, back off to the 170 bin
         outlon = 170
@@ -381,30 +379,17 @@ def add_five_points_to_polygon_side(polygon):
     x = Bounds([each[0] for each in polygon])
     y = Bounds([each[1] for each in polygon])
 
-    polylist.append((x.min, y.min))
-    dx = x.max - x.min
-    dy = y.min - y.min
-    for frac in fracs:
-        polylist.append((x.min + frac * dx, y.min + frac * dy))
-
-    polylist.append((x.max, y.min))
-    dx = x.max - x.max
-    dy = y.max - y.min
-    for frac in fracs:
-        polylist.append((x.max + frac * dx, y.min + frac * dy))
-
-    polylist.append((x.max, y.max))
-    dx = x.min - x.max
-    dy = y.max - y.max
-    for frac in fracs:
-        polylist.append((x.max + frac * dx, y.max + frac * dy))
-
-    polylist.append((x.min, y.max))
-    dx = x.min - x.min
-    dy = y.min - y.max
-    for frac in fracs:
-        polylist.append((x.min + frac * dx, y.max + frac * dy))
-
-    polylist.append((x.min, y.min))
+    # Walk polygon vertices counterclockwise starting with (min x, min y)
+    corners = [(x.min, y.min), (x.max, y.min), (x.max, y.max), (x.min, y.max), (x.min, y.min)]
+
+    for (x0, y0), (x1, y1) in zip(corners[:-1], corners[1:]):
+        polylist.append((x0, y0))
+
+        dx = x1 - x0
+        dy = y1 - y0
+        for frac in fracs:
+            polylist.append((x0 + frac * dx, y0 + frac * dy))
+
+    polylist.append(corners[-1])
 
     return polylist
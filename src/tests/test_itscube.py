@@ -0,0 +1,242 @@
+"""
+Tests for ITSCube selection of granules and writing of layers to the Zarr store.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'utils'))
+
+from itscube import ITSCube
+from itscube_types import Coords, DataVars
+
+
+LANDSAT_URL = 'https://its-live-data.s3.amazonaws.com/velocity_image_pair/landsatOLI/v02/N60W040/'
+
+LANDSAT_GRANULES = [
+    LANDSAT_URL + 'LC08_L1GT_007011_20130819_20200912_02_T2_X_LC08_L1GT_007011_20140806_20200911_02_T2_G0120V02_P044.nc',
+    LANDSAT_URL + 'LC08_L1TP_013010_20130330_20200913_02_T1_X_LE07_L1TP_012010_20130627_20200907_02_T1_G0120V02_P003.nc',
+    # L89 image pair
+    LANDSAT_URL + 'LC09_L1TP_013010_20220330_20220401_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc',
+    'LE07_L1TP_012010_20130627_20200907_02_T1_X_LC08_L1TP_013010_20130330_20200913_02_T1_G0120V02_P010.nc'
+]
+
+SENTINEL2_GRANULE = \
+    'S2A_MSIL1C_20170219T141051_N0204_R110_T20FQC_20170219T141048_X_' \
+    'S2B_MSIL1C_20180209T141039_N0206_R110_T20FQC_20180209T173117_G0120V02_P095.nc'
+
+SENTINEL1_GRANULE = \
+    'S1A_IW_SLC__1SSH_20160728T113645_20160728T113712_012348_0133B2_74C0_X_' \
+    'S1A_IW_SLC__1SSH_20160809T113646_20160809T113713_012523_013989_2C50_G0120V02_P030.nc'
+
+
+def make_layers(dates: list, flags: dict = None):
+    """
+    Create layers with 'v' and 'date_dt' data variables, and optional flags of
+    v[xyar] data variables.
+    """
+    mid_date_coord = pd.Index(pd.to_datetime(dates), name=Coords.MID_DATE)
+    num_layers = len(dates)
+
+    layers = xr.Dataset(
+        data_vars={
+            DataVars.V: (
+                [Coords.MID_DATE, Coords.Y, Coords.X],
+                np.ones((num_layers, 3, 4), dtype=np.float32)
+            ),
+            DataVars.ImgPairInfo.DATE_DT: (
+                [Coords.MID_DATE],
+                np.arange(num_layers, dtype=np.float32)
+            )
+        },
+        coords={
+            Coords.MID_DATE: mid_date_coord,
+            Coords.Y: np.arange(3, dtype=np.float64),
+            Coords.X: np.arange(4, dtype=np.float64)
+        }
+    )
+
+    for each, each_values in (flags or {}).items():
+        layers[each] = xr.DataArray(
+            data=np.array(each_values, dtype=np.int32),
+            coords=[mid_date_coord],
+            dims=[Coords.MID_DATE],
+            attrs={DataVars.STD_NAME: each}
+        )
+
+    return layers
+
+
+def test_append_layers_with_new_flag(tmp_path):
+    """
+    Append batch of layers that has a flag data variable which is not in the store yet.
+    """
+    output_dir = str(tmp_path / 'cube.zarr')
+
+    encoding = {
+        DataVars.ImgPairInfo.DATE_DT: {'chunks': (2,)},
+        Coords.MID_DATE: {'chunks': (2,)}
+    }
+    make_layers(['2020-01-01', '2020-01-02']).to_zarr(output_dir, encoding=encoding, consolidated=True)
+
+    cube = ITSCube.__new__(ITSCube)
+    cube.layers = make_layers(
+        ['2020-02-01', '2020-02-02', '2020-02-03'],
+        {DataVars.FLAG_STABLE_SHIFT: [1, 2, 0]}
+    )
+    cube.append_layers(output_dir)
+
+    with xr.open_dataset(output_dir, engine='zarr', consolidated=True) as ds:
+        assert ds.sizes[Coords.MID_DATE] == 5
+        assert ds[DataVars.ImgPairInfo.DATE_DT].values.tolist() == [0, 1, 0, 1, 2]
+
+        # Layers written before the flag appeared have no values for the flag
+        flag_values = ds[DataVars.FLAG_STABLE_SHIFT].values
+        assert np.isnan(flag_values[:2]).all()
+        assert flag_values[2:].tolist() == [1, 2, 0]
+        assert ds[DataVars.FLAG_STABLE_SHIFT].attrs[DataVars.STD_NAME] == DataVars.FLAG_STABLE_SHIFT
+
+
+def test_get_tokens_from_filenames():
+    """
+    Vectorized parsing of granule filenames extracts the same processing dates
+    and image pair identifiers as parsing of each filename.
+    """
+    tokens = ITSCube.get_tokens_from_filenames(LANDSAT_GRANULES)
+
+    assert len(tokens) == len(LANDSAT_GRANULES)
+
+    for each_url, each_proc_1, each_proc_2, each_id in zip(
+        LANDSAT_GRANULES,
+        tokens.proc_1,
+        tokens.proc_2,
+        tokens.id
+    ):
+        assert (each_proc_1, each_proc_2, each_id) == ITSCube.get_tokens_from_filename(each_url)
+
+
+@pytest.mark.parametrize('granule', [SENTINEL2_GRANULE, SENTINEL1_GRANULE])
+def test_get_tokens_from_filenames_non_landsat(granule):
+    """
+    Sentinel-1 and Sentinel-2 filenames don't follow Landsat naming convention
+    and are rejected by both vectorized and per-filename parsing.
+    """
+    with pytest.raises(RuntimeError):
+        ITSCube.get_tokens_from_filenames([LANDSAT_GRANULES[0], granule])
+
+    with pytest.raises(ValueError):
+        ITSCube.get_tokens_from_filename(granule)
+
+
+def test_skip_duplicate_l89_granules():
+    """
+    Keep granule with newer processing dates for the same Landsat8/9 image pair,
+    report skipped granules as provided.
+    """
+    older = LANDSAT_URL + 'LC08_L1TP_013010_20220330_20220401_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc'
+    newer = LANDSAT_URL + 'LC08_L1TP_013010_20220330_20220501_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc'
+    newest = LANDSAT_URL + 'LC08_L1TP_013010_20220330_20220501_02_T1_X_LC08_L1TP_013010_20220415_20220520_02_T1_G0120V02_P050.nc'
+
+    # Same image pair with identical processing dates in another projection
+    other_projection = newest.replace('N60W040', 'N60W050')
+
+    found_urls = [
+        older,
+        LANDSAT_GRANULES[1],
+        SENTINEL2_GRANULE,
+        newest,
+        SENTINEL2_GRANULE,
+        newer,
+        other_projection
+    ]
+
+    granules, skipped = ITSCube.skip_duplicate_l89_granules(iter(found_urls))
+
+    assert sorted(granules) == sorted([LANDSAT_GRANULES[1], SENTINEL2_GRANULE, newest, other_projection])
+    assert skipped == [older, newer]
+
+
+def test_skip_duplicate_l89_granules_no_landsat89():
+    """
+    Granules without Landsat8/9 images are returned as provided.
+    """
+    found_urls = [SENTINEL2_GRANULE, SENTINEL1_GRANULE]
+
+    assert ITSCube.skip_duplicate_l89_granules(found_urls) == (found_urls, [])
+
+
+def make_grid_layer(x_values, y_values, value):
+    """
+    Create layer on provided grid with float 'v' and integer 'interp_mask'
+    data variables.
+    """
+    data = value + np.arange(len(y_values)*len(x_values)).reshape((len(y_values), len(x_values)))
+
+    return xr.Dataset(
+        data_vars={
+            DataVars.V: ([Coords.Y, Coords.X], data.astype(np.float32), {DataVars.UNITS: DataVars.M_Y_UNITS}),
+            DataVars.INTERP_MASK: ([Coords.Y, Coords.X], data.astype(np.uint8))
+        },
+        coords={
+            Coords.X: np.array(x_values, dtype=np.float64),
+            Coords.Y: np.array(y_values, dtype=np.float64)
+        }
+    )
+
+
+def test_stack_layers():
+    """
+    Stacking layers into the datacube grid is identical to concatenation of
+    the layers followed by alignment to the datacube grid.
+    """
+    cube = ITSCube.__new__(ITSCube)
+    cube.grid_x = np.arange(0, 60, 10, dtype=np.float64)
+    cube.grid_y = np.arange(50, -10, -10, dtype=np.float64)
+    cube.grid_cells = {}
+
+    cube.ds = [
+        # Layer covers the whole grid
+        make_grid_layer(cube.grid_x, cube.grid_y, 0),
+        # Layer is offset by one cell in both directions: partially outside of the grid
+        make_grid_layer(cube.grid_x + 10, cube.grid_y - 10, 50),
+        # Layer covers part of the grid only
+        make_grid_layer(cube.grid_x[1:4], cube.grid_y[2:], 100),
+        # Layer on the same grid as the second layer
+        make_grid_layer(cube.grid_x + 10, cube.grid_y - 10, 150),
+        # Layer every other cell of which is within the grid
+        make_grid_layer(np.arange(-5, 60, 5), cube.grid_y[::2], 200)
+    ]
+    mid_date_coord = pd.Index(
+        pd.date_range('2020-01-01', periods=len(cube.ds)),
+        name=Coords.MID_DATE
+    )
+    var_names = [DataVars.V, DataVars.INTERP_MASK]
+
+    layers = cube.stack_layers(var_names, mid_date_coord)
+
+    # Grids of the layers are cached by their coordinates
+    assert len(cube.grid_cells) == 4
+
+    for each_var in var_names:
+        expected = xr.concat([ds[each_var] for ds in cube.ds], mid_date_coord).reindex(
+            {Coords.X: cube.grid_x, Coords.Y: cube.grid_y}
+        ).transpose(Coords.MID_DATE, Coords.Y, Coords.X)
+
+        # Integer data is stacked as the smallest float type that holds its
+        # values and NaN for cells not covered by the layer (as
+        # xarray.core.dtypes.maybe_promote() does). Alignment of the layers by
+        # xr.concat() gets float64 for any integer type instead. Values written
+        # to the store are the same as data type of the store is set by encoding.
+        expected_dtype, _ = xr.core.dtypes.maybe_promote(cube.ds[0][each_var].dtype)
+        assert layers[each_var].dtype == expected_dtype
+
+        # Stacked data variable gets its name when it's added to the layers
+        xr.testing.assert_identical(layers[each_var].rename(each_var), expected.astype(expected_dtype))
+
+    assert np.isnan(layers[DataVars.INTERP_MASK].values[1, 0, :]).all()
+    assert np.isnan(layers[DataVars.INTERP_MASK].values[2, :2, :]).all()
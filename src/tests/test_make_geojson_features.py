@@ -0,0 +1,243 @@
+"""
+Tests for generation of ITS_LIVE granule catalog geojson files.
+"""
+import fnmatch
+import geojson
+import io
+import json
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'utils'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tools'))
+
+import make_geojson_features_for_imagepairs_v1p1 as catalog
+
+
+LANDSAT_DIR = 'its-live-data/velocity_image_pair/landsatOLI/v02/N60W040/'
+SENTINEL1_DIR = 'its-live-data/velocity_image_pair/sentinel1/v02/N60W040/'
+
+FOUND_URLS = [
+    # Duplicate optical granules: the second one has newer processing date
+    LANDSAT_DIR + 'LC08_L1TP_013010_20220330_20220401_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc',
+    LANDSAT_DIR + 'LC08_L1TP_013010_20220330_20220501_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc',
+    # Unique optical granule
+    LANDSAT_DIR + 'LC08_L1TP_013010_20130330_20200913_02_T1_X_LE07_L1TP_012010_20130627_20200907_02_T1_G0120V02_P003.nc',
+    # Duplicate radar granule of the granule below
+    SENTINEL1_DIR + 'S1A_IW_SLC__1SSH_20160728T113645_20160728T113712_012348_0133B2_74C0_X_S1A_IW_SLC__1SSH_20160809T113646_20160809T113713_012523_013989_2C50_G0120V02_P030.nc',
+    # Duplicate optical granule with older processing date than the first one
+    LANDSAT_DIR + 'LC08_L1TP_013010_20220330_20220301_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc',
+    # Unique radar granule
+    SENTINEL1_DIR + 'S1B_IW_SLC__1SSH_20170221T204710_20170221T204737_015387_0193F6_AB07_X_S1B_IW_SLC__1SSH_20170227T204628_20170227T204655_004491_007D11_6654_G0240V02_P094.nc',
+    # Same optical granule as the second one in other projection: both are kept
+    LANDSAT_DIR.replace('N60W040', 'N60W050') + 'LC08_L1TP_013010_20220330_20220501_02_T1_X_LC08_L1TP_013010_20220415_20220420_02_T1_G0120V02_P050.nc',
+    SENTINEL1_DIR + 'S1A_IW_SLC__1SSH_20160728T113645_20160728T113712_012348_0133B2_74C1_X_S1A_IW_SLC__1SSH_20160809T113646_20160809T113713_012523_013989_2C51_G0120V02_P030.nc',
+    # Duplicate optical granules with newer proc_1 and older proc_2
+    LANDSAT_DIR + 'LC08_L1GT_007011_20130819_20200912_02_T2_X_LC08_L1GT_007011_20140806_20200911_02_T2_G0120V02_P044.nc',
+    LANDSAT_DIR + 'LC08_L1GT_007011_20130819_20200915_02_T2_X_LC08_L1GT_007011_20140806_20200901_02_T2_G0120V02_P044.nc'
+]
+
+
+def skip_duplicate_granules_full_parse(found_urls: list):
+    """
+    Skip duplicate granules by parsing all of the granules filenames: previous
+    implementation of skip_duplicate_granules() the result is compared to.
+    """
+    keep_urls = {}
+    skipped_double_granules = []
+
+    for each_url in found_urls:
+        is_optical, url_acq_1, url_proc_1, key_1, url_acq_2, url_proc_2, key_2 = \
+            catalog.get_tokens_from_filename(each_url)
+
+        if is_optical:
+            granule_id = '_'.join([
+                url_acq_1.strftime(catalog.DATE_FORMAT),
+                key_1,
+                url_acq_2.strftime(catalog.DATE_FORMAT),
+                key_2
+            ])
+
+        else:
+            granule_id = '_'.join([
+                url_acq_1.strftime(catalog.DATE_TIME_FORMAT),
+                url_proc_1.strftime(catalog.DATE_TIME_FORMAT),
+                url_acq_2.strftime(catalog.DATE_TIME_FORMAT),
+                url_proc_2.strftime(catalog.DATE_TIME_FORMAT),
+            ])
+
+        if granule_id not in keep_urls or not is_optical:
+            keep_urls.setdefault(granule_id, []).append(each_url)
+            continue
+
+        found_proc = [catalog.get_tokens_from_filename(each)[2::3] for each in keep_urls[granule_id]]
+
+        if (url_proc_1, url_proc_2) in found_proc:
+            keep_urls[granule_id].append(each_url)
+            continue
+
+        remove_urls = [
+            found_url for found_url, (found_proc_1, found_proc_2) in zip(keep_urls[granule_id], found_proc)
+            if (url_proc_1 >= found_proc_1 and url_proc_2 >= found_proc_2) or url_proc_1 > found_proc_1
+        ]
+
+        if len(remove_urls):
+            skipped_double_granules.extend(remove_urls)
+            keep_urls[granule_id][:] = [each for each in keep_urls[granule_id] if each not in remove_urls]
+            keep_urls[granule_id].append(each_url)
+
+        else:
+            skipped_double_granules.append(each_url)
+
+    granules = []
+    for each in keep_urls.values():
+        granules.extend(each)
+
+    return granules, skipped_double_granules
+
+
+@pytest.mark.parametrize('min_parallel_parse_urls', [catalog.MIN_PARALLEL_PARSE_URLS, 1])
+def test_skip_duplicate_granules(monkeypatch, min_parallel_parse_urls):
+    """
+    Parsing only granules that share granule ID with other granules, in the
+    current process or in parallel processes, gives the same result as parsing
+    all of the granules.
+    """
+    monkeypatch.setattr(catalog, 'MIN_PARALLEL_PARSE_URLS', min_parallel_parse_urls)
+
+    granules, skipped = catalog.skip_duplicate_granules(FOUND_URLS, num_workers=2)
+
+    assert (granules, skipped) == skip_duplicate_granules_full_parse(FOUND_URLS)
+
+    assert skipped == [FOUND_URLS[0], FOUND_URLS[4], FOUND_URLS[8]]
+    assert sorted(granules) == sorted(set(FOUND_URLS).difference(skipped))
+
+
+def make_features(num_features: int):
+    """
+    Create granule features as they are created for the catalog.
+    """
+    return [
+        {
+            'type': 'Feature',
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[-40.0, 60.0 + index], [-39.5, 60.0 + index], [-40.0, 60.0 + index]]]
+            },
+            'properties': {
+                'filename': os.path.basename(FOUND_URLS[index % len(FOUND_URLS)]),
+                'data_epsg': 32624,
+                # Stable shift can be set to NaN
+                'stable_shift': math.nan if index % 2 else 0.5,
+                'img_pair_info_dict': {'date_dt': 16.0, 'sensor_img1': 'C'}
+            }
+        } for index in range(num_features)
+    ]
+
+
+@pytest.mark.parametrize('num_features', [0, 1, 5])
+def test_feature_stream(num_features):
+    """
+    Streamed features are identical to the features written as FeatureCollection.
+    """
+    features = make_features(num_features)
+
+    outf = io.StringIO()
+    feature_stream = catalog.FeatureStream(outf)
+    for each in features:
+        feature_stream.write(each)
+    feature_stream.close()
+
+    expected = io.StringIO()
+    json.dump(geojson.FeatureCollection(features), expected)
+
+    assert outf.getvalue() == expected.getvalue()
+
+
+@pytest.mark.parametrize('num_features', [0, 1, 5])
+def test_ndjson_feature_stream(num_features):
+    """
+    Streamed features are written one feature per line, and metadata reports
+    number of written features.
+    """
+    features = make_features(num_features)
+
+    outf = io.StringIO()
+    feature_stream = catalog.NDJSONFeatureStream(outf)
+    for each in features:
+        feature_stream.write(each)
+    feature_stream.close()
+
+    lines = outf.getvalue().split('\n')
+
+    # Each feature is on its own line terminated by newline, no features
+    # result in empty file
+    assert len(lines) == num_features + 1
+    assert lines[-1] == ''
+    assert lines[:-1] == [json.dumps(each) for each in features]
+
+    assert feature_stream.metadata('features.ndjson') == {
+        'type': 'FeatureCollection',
+        'features_file': 'features.ndjson',
+        'num_features': num_features
+    }
+
+
+class GlobFileSystem:
+    """
+    Replacement for s3fs.S3FileSystem that lists and globs provided files.
+    """
+    def __init__(self, files: list):
+        self.files = files
+
+    def ls(self, path: str, detail: bool = False):
+        path = path.rstrip('/') + '/'
+        entries = {}
+        for each in self.files:
+            if each.startswith(path):
+                name, _, sub_path = each[len(path):].partition('/')
+                entries[path + name] = 'directory' if len(sub_path) else 'file'
+
+        if not detail:
+            return list(entries)
+
+        return [{'name': name, 'type': entry_type} for name, entry_type in entries.items()]
+
+    def glob(self, path: str):
+        # "*" does not match across sub-directories, "**" does
+        pattern = path.split('/')
+        return [
+            each for each in self.files
+            if fnmatch.fnmatchcase(each, path) and ('**' in path or (
+                len(each.split('/')) == len(pattern) and
+                all(fnmatch.fnmatchcase(*each_token) for each_token in zip(each.split('/'), pattern))
+            ))
+        ]
+
+
+@pytest.mark.parametrize('glob_pattern', ['*/*.nc', 'N6*/*.nc', 'N60W0[45]0/*_P0*.nc', '*.json', '**/*.nc'])
+def test_glob_granules(glob_pattern):
+    """
+    Search of granules by sub-directories finds the same granules as a single
+    search of the whole granules directory.
+    """
+    granules_dir = 'its-live-data/velocity_image_pair/landsatOLI/v02'
+    s3 = GlobFileSystem(
+        [granules_dir + '/catalog.json'] + [
+            granules_dir + '/' + each_dir + '/' + os.path.basename(each_url)
+            for each_dir in ['N60W040', 'N60W050', 'N70W040', 'S80E170']
+            for each_url in FOUND_URLS[:3]
+        ] + [
+            granules_dir + '/N60W040/temp/' + os.path.basename(FOUND_URLS[0]),
+            granules_dir + '/N60W050/' + os.path.basename(FOUND_URLS[0]).replace('.nc', '.txt')
+        ]
+    )
+
+    expected = sorted(s3.glob(f'{granules_dir}/{glob_pattern}'))
+    assert len(expected)
+
+    assert sorted(catalog.glob_granules(s3, granules_dir, glob_pattern, num_workers=2)) == expected
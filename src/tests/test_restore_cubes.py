@@ -0,0 +1,364 @@
+"""
+Tests for restoring M11/M12 values of ITS_LIVE datacubes.
+"""
+import collections
+import numpy as np
+import os
+import pandas as pd
+import pytest
+import subprocess
+import sys
+import threading
+import time
+import xarray as xr
+import zarr
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'utils'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'tools'))
+
+from itscube_types import Coords, DataVars, ShapeFile
+from restore_cubes_S1_M11_M12 import FixDatacubes, GranuleCache
+
+
+class PipelineStages:
+    """
+    Replacement for FixDatacubes.all() and FixDatacubes.upload() that tracks
+    concurrency of the pipeline stages.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fixing = 0
+        self.max_fixing = 0
+        self.fixed = []
+        self.uploaded = []
+        self.max_waiting_upload = 0
+        self.s3_clients = set()
+
+    def all(self, cube_url, bucket_dir, target_bucket_dir, local_original_cube_dir, local_dir, s3, *args):
+        with self.lock:
+            self.s3_clients.add(id(s3))
+            self.fixing += 1
+            self.max_fixing = max(self.max_fixing, self.fixing)
+
+        time.sleep(0.01)
+
+        with self.lock:
+            self.fixing -= 1
+            self.fixed.append(cube_url)
+            self.max_waiting_upload = max(self.max_waiting_upload, len(self.fixed) - len(self.uploaded))
+
+        return [f'Fixed {cube_url}']
+
+    def upload(self, cube_url, *args):
+        # Uploads are slower than fixes
+        time.sleep(0.05)
+
+        with self.lock:
+            self.uploaded.append(cube_url)
+
+        return [f'Uploaded {cube_url}']
+
+
+def test_pipeline_processes_all_cubes(monkeypatch):
+    """
+    Fix and upload more datacubes than there are workers, starting with "start_cube".
+    """
+    stages = PipelineStages()
+    monkeypatch.setattr(FixDatacubes, 'all', stages.all)
+    monkeypatch.setattr(FixDatacubes, 'upload', stages.upload)
+
+    num_workers = 3
+    fix_cubes = FixDatacubes.__new__(FixDatacubes)
+    fix_cubes.s3 = object()
+    fix_cubes.bucket_dir = 'datacubes/v2'
+    fix_cubes.target_bucket_dir = 'datacubes/v2_restored'
+    fix_cubes.local_original_cube_dir = 'original'
+    fix_cubes.local_dir = 'fixed'
+    fix_cubes.all_zarr_datacubes = [f'cube_{index:02d}.zarr' for index in range(20)]
+
+    fix_cubes(num_workers, start_cube=2)
+
+    expected = fix_cubes.all_zarr_datacubes[2:]
+    assert sorted(stages.fixed) == expected
+    assert sorted(stages.uploaded) == expected
+
+    assert stages.max_fixing <= num_workers
+
+    # All datacubes share the same S3 client
+    assert stages.s3_clients == {id(fix_cubes.s3)}
+
+    # Fixing doesn't get ahead of slower uploads by more than pending uploads
+    # and datacubes being fixed
+    assert stages.max_waiting_upload <= 2*num_workers
+
+
+class S3FileSystem:
+    """
+    Replacement for s3fs.S3FileSystem that lists two datacubes per directory.
+    """
+    instances = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        S3FileSystem.instances.append(self)
+
+    def ls(self, path):
+        if path.endswith('.zarr') or path.count('/') > 2:
+            return [f'{path}/cube_1.zarr', f'{path}/cube_0.zarr', f'{path}/cube.json']
+
+        return [f'{path}/N10W010', f'{path}/N00W010']
+
+
+def test_single_s3_client(monkeypatch, tmp_path):
+    """
+    One S3 client with connection pool for concurrent granule downloads of all
+    workers is used to list and fix the datacubes.
+    """
+    monkeypatch.setattr('restore_cubes_S1_M11_M12.s3fs.S3FileSystem', S3FileSystem)
+    S3FileSystem.instances = []
+
+    num_workers = 3
+    fix_cubes = FixDatacubes(
+        'its-live-data',
+        'datacubes/v2',
+        'datacubes/v2_restored',
+        str(tmp_path / 'original'),
+        str(tmp_path / 'fixed'),
+        num_workers
+    )
+
+    assert len(S3FileSystem.instances) == 1
+    assert fix_cubes.s3 is S3FileSystem.instances[0]
+    assert fix_cubes.s3.kwargs['config_kwargs']['max_pool_connections'] == num_workers*FixDatacubes.NUM_PREFETCH_GRANULES
+    assert fix_cubes.all_zarr_datacubes == [
+        'its-live-data/datacubes/v2/N00W010/cube_0.zarr',
+        'its-live-data/datacubes/v2/N00W010/cube_1.zarr',
+        'its-live-data/datacubes/v2/N10W010/cube_0.zarr',
+        'its-live-data/datacubes/v2/N10W010/cube_1.zarr'
+    ]
+
+    stages = PipelineStages()
+    monkeypatch.setattr(FixDatacubes, 'all', stages.all)
+    monkeypatch.setattr(FixDatacubes, 'upload', stages.upload)
+
+    fix_cubes(num_workers)
+
+    assert len(S3FileSystem.instances) == 1
+    assert stages.s3_clients == {id(fix_cubes.s3)}
+
+
+def make_cube(cube_store: str, chunks_1d: tuple):
+    """
+    Create datacube without S1 layers.
+
+    chunks_1d: Chunking of 1-d data variables other than 'date_dt'.
+    """
+    num_layers, num_y, num_x = 5, 3, 4
+    compressor = zarr.Blosc(cname='zlib', clevel=2, shuffle=1)
+    values = np.arange(num_layers*num_y*num_x, dtype=np.float32).reshape((num_layers, num_y, num_x))
+
+    ds = xr.Dataset(
+        data_vars={
+            DataVars.ImgPairInfo.DATE_DT: ([Coords.MID_DATE], np.arange(num_layers, dtype=np.float32)),
+            DataVars.ImgPairInfo.SATELLITE_IMG1: ([Coords.MID_DATE], np.array(['8.', '9.', '8.', '7.', '2A'])),
+            DataVars.FLAG_STABLE_SHIFT: ([Coords.MID_DATE], np.array([1, 2, 0, 1, 1], dtype=np.uint8)),
+            DataVars.URL: ([Coords.MID_DATE], np.array([f'granule_{index}.nc' for index in range(num_layers)])),
+            DataVars.V: ([Coords.MID_DATE, Coords.Y, Coords.X], values, {DataVars.UNITS: DataVars.M_Y_UNITS}),
+            DataVars.M11: ([Coords.MID_DATE, Coords.Y, Coords.X], values / 10),
+            DataVars.M12: ([Coords.MID_DATE, Coords.Y, Coords.X], values / 100),
+            DataVars.CHIP_SIZE_HEIGHT: ([Coords.MID_DATE, Coords.Y, Coords.X], values.astype(np.uint16)),
+            ShapeFile.LANDICE: ([Coords.Y, Coords.X], np.ones((num_y, num_x), dtype=np.uint8))
+        },
+        coords={
+            Coords.MID_DATE: pd.date_range('2020-01-01', periods=num_layers),
+            Coords.Y: np.arange(num_y, dtype=np.float64),
+            Coords.X: np.arange(num_x, dtype=np.float64)
+        }
+    )
+
+    encoding = {
+        Coords.MID_DATE: {'chunks': (2,)},
+        DataVars.ImgPairInfo.DATE_DT: {'chunks': (num_layers,), 'compressor': compressor},
+        DataVars.ImgPairInfo.SATELLITE_IMG1: {'chunks': chunks_1d, 'compressor': compressor},
+        DataVars.FLAG_STABLE_SHIFT: {'chunks': chunks_1d, 'compressor': compressor},
+        DataVars.URL: {'chunks': chunks_1d, 'compressor': compressor},
+        ShapeFile.LANDICE: {'chunks': (num_y, num_x), 'compressor': compressor}
+    }
+    for each in [DataVars.V, DataVars.M11, DataVars.M12, DataVars.CHIP_SIZE_HEIGHT]:
+        encoding[each] = {'chunks': (num_layers, 2, 2), 'compressor': compressor}
+
+    ds.to_zarr(cube_store, encoding=encoding, consolidated=True)
+
+
+@pytest.mark.parametrize('chunks_1d, copied', [
+    # Re-chunking of 1-d data variables to include all layers changes the chunks
+    ((2,), False),
+    # Chunks of 1-d data variables include all layers already
+    ((5,), True)
+])
+def test_copy_unchanged_vars(monkeypatch, tmp_path, chunks_1d, copied):
+    """
+    Data variables that don't change by the fix are copied to the fixed
+    datacube as they are stored, the fixed datacube is identical to the
+    original one.
+    """
+    cube_url = 'its-live-data/datacubes/v2/N60W040/cube.zarr'
+    local_original_cube_dir = tmp_path / 'original'
+    local_dir = tmp_path / 'fixed'
+    local_original_cube_dir.mkdir()
+    local_dir.mkdir()
+
+    original_cube = str(local_original_cube_dir / 'cube.zarr')
+    fixed_cube = str(local_dir / 'cube.zarr')
+    make_cube(original_cube, chunks_1d)
+
+    # Datacube is already copied locally
+    monkeypatch.setattr(
+        'restore_cubes_S1_M11_M12.subprocess.run',
+        lambda command_line, **kwargs: subprocess.CompletedProcess(command_line, 0, b'')
+    )
+
+    with xr.open_dataset(original_cube, engine='zarr', consolidated=True) as ds:
+        all_vars = list(ds.data_vars)
+
+    msgs = FixDatacubes.all(
+        cube_url,
+        'datacubes/v2',
+        'datacubes/v2_restored',
+        str(local_original_cube_dir),
+        str(local_dir),
+        None,
+        FixDatacubes.NUM_PREFETCH_GRANULES
+    )
+
+    # Variables with the same chunks as required by the fix are copied
+    always_copied = [DataVars.ImgPairInfo.DATE_DT, DataVars.V, DataVars.M11, DataVars.M12, DataVars.CHIP_SIZE_HEIGHT, ShapeFile.LANDICE]
+    rechunked = [DataVars.ImgPairInfo.SATELLITE_IMG1, DataVars.FLAG_STABLE_SHIFT, DataVars.URL]
+
+    expected_copy_vars = [each for each in all_vars if each in always_copied or (copied and each in rechunked)]
+    assert f'Copy unchanged data variables: {expected_copy_vars}' in msgs
+
+    with xr.open_dataset(original_cube, engine='zarr', consolidated=True) as original_ds, \
+         xr.open_dataset(fixed_cube, engine='zarr', consolidated=True) as fixed_ds:
+        assert fixed_ds[all_vars].identical(original_ds)
+
+        # There are no S1 layers to set flight direction for
+        for each_var in [DataVars.ASCENDING_IMG1, DataVars.ASCENDING_IMG2]:
+            assert np.isnan(fixed_ds[each_var].values).all()
+
+    original_group = zarr.open_consolidated(original_cube, mode='r')
+    fixed_group = zarr.open_consolidated(fixed_cube, mode='r')
+
+    for each_var in all_vars:
+        if each_var in expected_copy_vars:
+            # Stored chunks are copied as they are
+            assert sorted(os.listdir(os.path.join(fixed_cube, each_var))) == \
+                sorted(os.listdir(os.path.join(original_cube, each_var)))
+            assert fixed_group[each_var].chunks == original_group[each_var].chunks
+
+        else:
+            # 1-d data variables are re-chunked to include all layers
+            assert fixed_group[each_var].chunks == (5,)
+
+
+class CatFileSystem:
+    """
+    Replacement for s3fs.S3FileSystem that returns granule content and counts
+    the downloads.
+    """
+    def __init__(self):
+        self.num_cat = collections.Counter()
+
+    def cat(self, path: str):
+        self.num_cat[path] += 1
+        return path.encode().ljust(10, b'.')[:10]
+
+
+def test_granule_cache_hit(tmp_path):
+    """
+    Granule is downloaded only once while it's in the cache.
+    """
+    s3 = CatFileSystem()
+    cache = GranuleCache(str(tmp_path / 'cache'), 100)
+
+    assert cache.get('granule_a', s3) == b'granule_a.'
+    assert cache.get('granule_a', s3) == b'granule_a.'
+    assert cache.get('granule_b', s3) == b'granule_b.'
+
+    assert s3.num_cat == {'granule_a': 1, 'granule_b': 1}
+    assert cache.num_bytes == 20
+    assert len(cache.cached_files()) == 2
+
+
+def test_granule_cache_eviction(tmp_path):
+    """
+    Least recently used granules are evicted once the cache exceeds its size.
+    """
+    s3 = CatFileSystem()
+    cache = GranuleCache(str(tmp_path / 'cache'), 25)
+
+    cache.get('granule_a', s3)
+    file_a, = cache.cached_files()
+
+    cache.get('granule_b', s3)
+    file_b, = set(cache.cached_files()).difference([file_a])
+
+    # granule_a is downloaded before granule_b
+    os.utime(file_a, (1000, 1000))
+    os.utime(file_b, (2000, 2000))
+
+    # Reading granule_a from the cache makes it the most recently used
+    cache.get('granule_a', s3)
+
+    cache.get('granule_c', s3)
+    file_c, = set(cache.cached_files()).difference([file_a, file_b])
+
+    assert sorted(cache.cached_files()) == sorted([file_a, file_c])
+    assert cache.num_bytes == 20
+
+    # Evicted granule is downloaded again
+    assert cache.get('granule_a', s3) == b'granule_a.'
+    assert cache.get('granule_b', s3) == b'granule_b.'
+
+    assert s3.num_cat == {'granule_a': 1, 'granule_b': 2, 'granule_c': 1}
+    assert cache.num_bytes == 20
+    assert len(cache.cached_files()) == 2
+
+
+def test_granule_cache_restart(tmp_path):
+    """
+    Cache accounts for granules cached by previous runs, and removes temporary
+    files of interrupted downloads.
+    """
+    s3 = CatFileSystem()
+    cache_dir = str(tmp_path / 'cache')
+
+    cache = GranuleCache(cache_dir, 100)
+    cache.get('granule_a', s3)
+    cache.get('granule_b', s3)
+    cached_files = sorted(cache.cached_files())
+
+    # Download interrupted while writing to the temporary file
+    with open(f'{cached_files[0]}.{threading.get_ident()}', 'wb') as fh:
+        fh.write(b'partial')
+
+    cache = GranuleCache(cache_dir, 100)
+
+    assert cache.num_bytes == 20
+    assert sorted(os.listdir(cache_dir)) == [os.path.basename(each) for each in cached_files]
+
+    # Granules cached by previous run are not downloaded again
+    assert cache.get('granule_a', s3) == b'granule_a.'
+    assert s3.num_cat == {'granule_a': 1, 'granule_b': 1}
+
+    # Cache smaller than granules cached by previous run is reduced on next download
+    cache = GranuleCache(cache_dir, 15)
+    assert cache.num_bytes == 20
+
+    for each_file in cached_files:
+        os.utime(each_file, (1000, 1000))
+
+    cache.get('granule_c', s3)
+    assert cache.num_bytes == 10
+    assert len(cache.cached_files()) == 1
@@ -5,13 +5,20 @@ Authors: Mark Fahnestock, Masha Liukis
 """
 
 import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import dask
 from dask.diagnostics import ProgressBar
 from datetime import datetime
+import fnmatch
+import functools
 import geojson
 import h5py
+import io
+import itertools
 import json
 import logging
+import math
 import numpy as np
 import os
 import psutil
@@ -20,8 +27,13 @@ import s3fs
 import sys
 import time
 from tqdm import tqdm
-from shapely.geometry import mapping
-import xarray as xr
+
+try:
+    # Use faster JSON parser for lists of granules if it's available
+    import orjson as _json
+
+except ImportError:
+    _json = json
 
 # from itscube import ITSCube
 
@@ -33,6 +45,34 @@ DATE_FORMAT = "%Y%m%d"
 # S1A_IW_SLC__1SSH_20170221T204710_20170221T204737_015387_0193F6_AB07_X_S1B_IW_SLC__1SSH_20170227T204628_20170227T204655_004491_007D11_6654_G0240V02_P094.nc
 DATE_TIME_FORMAT = "%Y%m%dT%H%M%S"
 
+# Minimum number of granules filenames to parse in parallel processes: fewer
+# filenames are parsed faster in the current process than it takes to start
+# the processes
+MIN_PARALLEL_PARSE_URLS = 10000
+
+# Number of decimal places to keep for polygon coordinates of the granule feature
+GEOJSON_PRECISION = 6
+
+# Number of S3 sub-directories to list concurrently when searching for granules
+NUM_LIST_WORKERS = 32
+
+def parse_date(value: str):
+    """
+    Parse date (DATE_FORMAT) or date and time (DATE_TIME_FORMAT) as they appear
+    in granules filenames. This is much faster than datetime.strptime() for
+    the fixed width formats.
+    """
+    if len(value) == 8:
+        return datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+    if len(value) == 15 and value[8] == 'T':
+        return datetime(
+            int(value[0:4]), int(value[4:6]), int(value[6:8]),
+            int(value[9:11]), int(value[11:13]), int(value[13:15])
+        )
+
+    raise ValueError(f"Unexpected date format: {value}")
+
 def get_tokens_from_filename(filename):
     """
     Extract acquisition/processing dates and path/row for two images from the
@@ -42,7 +82,9 @@ def get_tokens_from_filename(filename):
     # Optical format granules have different file naming convention than radar
     # format granules
     is_optical = True
-    url_files = os.path.basename(filename).split('_X_')
+    # Slice filename off the path directly: os.path.basename() is noticeably
+    # slower for millions of granules
+    url_files = filename[filename.rfind('/')+1:].split('_X_')
 
     # Get tokens for the first image name
     url_tokens = url_files[0].split('_')
@@ -50,13 +92,13 @@ def get_tokens_from_filename(filename):
     if len(url_tokens) < 9:
         # Optical format granule
         # Get acquisition/processing dates and path&row for both images
-        first_date_1 = datetime.strptime(url_tokens[3], DATE_FORMAT)
-        second_date_1 = datetime.strptime(url_tokens[4], DATE_FORMAT)
+        first_date_1 = parse_date(url_tokens[3])
+        second_date_1 = parse_date(url_tokens[4])
         key_1 = url_tokens[2]
 
         url_tokens = url_files[1].split('_')
-        first_date_2 = datetime.strptime(url_tokens[3], DATE_FORMAT)
-        second_date_2 = datetime.strptime(url_tokens[4], DATE_FORMAT)
+        first_date_2 = parse_date(url_tokens[3])
+        second_date_2 = parse_date(url_tokens[4])
         key_2 = url_tokens[2]
 
     else:
@@ -66,9 +108,9 @@ def get_tokens_from_filename(filename):
 
         url_tokens = url_files[0].split('_')
         # Start date and time
-        first_date_1 = datetime.strptime(url_tokens[-5], DATE_TIME_FORMAT)
+        first_date_1 = parse_date(url_tokens[-5])
         # Stop date and time
-        second_date_1 = datetime.strptime(url_tokens[-4], DATE_TIME_FORMAT)
+        second_date_1 = parse_date(url_tokens[-4])
         # Product unique identifier
         key_1 = url_tokens[-1]
 
@@ -76,47 +118,102 @@ def get_tokens_from_filename(filename):
         # at the end of the filename which are specific to ITS_LIVE filename
         url_tokens = url_files[1].split('_')
         # Start date and time
-        first_date_2 = datetime.strptime(url_tokens[-7], DATE_TIME_FORMAT)
+        first_date_2 = parse_date(url_tokens[-7])
         # Stop date and time
-        second_date_2 = datetime.strptime(url_tokens[-6], DATE_TIME_FORMAT)
+        second_date_2 = parse_date(url_tokens[-6])
         # Product unique identifier
         key_2 = url_tokens[-3]
 
     return is_optical, first_date_1, second_date_1, key_1, first_date_2, second_date_2, key_2
 
-def skip_duplicate_granules(found_urls: list):
+def get_granule_id_from_filename(filename):
+    """
+    Get ID of the granule from its filename: duplicate granules have the same ID.
+    ID consists of acquisition dates and path/row for two images of optical
+    granule, or start/end date/time of two images of radar granule.
+
+    The ID is built from filename tokens as they are, without parsing the dates,
+    which makes it cheap to identify granules that have no duplicates.
+    """
+    url_files = filename[filename.rfind('/')+1:].split('_X_')
+
+    # Get tokens for both image names
+    url_tokens_1 = url_files[0].split('_')
+    url_tokens_2 = url_files[1].split('_')
+
+    if len(url_tokens_1) < 9:
+        # Optical format granule:
+        # acquisition time and path/row of images should be identical for
+        # duplicate granules
+        return '_'.join([
+            url_tokens_1[3],
+            url_tokens_1[2],
+            url_tokens_2[3],
+            url_tokens_2[2]
+        ])
+
+    # Radar format granule: start/stop date/time of both images (there are
+    # two extra tokens at the end of the second image name which are specific
+    # to ITS_LIVE filename)
+    return '_'.join([
+        url_tokens_1[-5],
+        url_tokens_1[-4],
+        url_tokens_2[-7],
+        url_tokens_2[-6]
+    ])
+
+
+def skip_duplicate_granules(found_urls: list, num_workers: int = None):
     """
     Skip duplicate granules (the ones that have earlier processing date(s)).
+
+    num_workers: Number of parallel processes to parse granules filenames with.
+        Default is the number of CPUs.
     """
     # Need to remove duplicate granules for the middle date: some granules
     # have newer processing date, keep those.
+    # Keep processing dates along with each URL to avoid re-parsing URLs
+    # that are already kept: (url, proc_1, proc_2)
     keep_urls = {}
     skipped_double_granules = []
 
-    for each_url in tqdm(found_urls, ascii=True, desc='Skipping duplicate granules...'):
-        # Extract acquisition and processing dates for optical granule,
-        # start/end date/time and product unique ID for radar granule
-        is_optical, url_acq_1, url_proc_1, key_1, url_acq_2, url_proc_2, key_2 = \
-            get_tokens_from_filename(each_url)
-
-        if is_optical:
-            # Acquisition time and path/row of images should be identical for
-            # duplicate granules
-            granule_id = '_'.join([
-                url_acq_1.strftime(DATE_FORMAT),
-                key_1,
-                url_acq_2.strftime(DATE_FORMAT),
-                key_2
-            ])
+    # Identify granules that share ID with other granules: only these need to
+    # have their filenames parsed and processing dates compared
+    granule_ids = [get_granule_id_from_filename(each) for each in found_urls]
+    num_granules_per_id = collections.Counter(granule_ids)
 
-        else:
-            # Start/stop date/time of both images
-            granule_id = '_'.join([
-                url_acq_1.strftime(DATE_TIME_FORMAT),
-                url_proc_1.strftime(DATE_TIME_FORMAT),
-                url_acq_2.strftime(DATE_TIME_FORMAT),
-                url_proc_2.strftime(DATE_TIME_FORMAT),
-            ])
+    duplicate_urls = [
+        each_url for each_url, each_id in zip(found_urls, granule_ids) if num_granules_per_id[each_id] > 1
+    ]
+    logging.info(f"Found {len(duplicate_urls)} granules with the same granule ID")
+
+    # Extract acquisition and processing dates for optical granule,
+    # start/end date/time and product unique ID for radar granule: parse
+    # all filenames (in parallel if there are many) before identifying duplicate granules
+    if len(duplicate_urls) < MIN_PARALLEL_PARSE_URLS:
+        all_tokens = {each_url: get_tokens_from_filename(each_url) for each_url in duplicate_urls}
+
+    else:
+        num_workers = num_workers or os.cpu_count()
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            # Send each of the processes a single chunk of filenames
+            all_tokens = dict(zip(
+                duplicate_urls,
+                executor.map(
+                    get_tokens_from_filename,
+                    duplicate_urls,
+                    chunksize=math.ceil(len(duplicate_urls)/num_workers)
+                )
+            ))
+
+    for each_url, granule_id in tqdm(zip(found_urls, granule_ids), total=len(found_urls), ascii=True, desc='Skipping duplicate granules...'):
+        if num_granules_per_id[granule_id] == 1:
+            # This is the only granule for the ID, no need to check processing dates
+            keep_urls[granule_id] = [(each_url, None, None)]
+            continue
+
+        is_optical, _, url_proc_1, _, _, url_proc_2, _ = all_tokens[each_url]
 
         # There is a granule for the mid_date already:
         # * For radar granule: issue a warning reporting product unique ID for duplicate granules
@@ -125,26 +222,23 @@ def skip_duplicate_granules(found_urls: list):
         if granule_id in keep_urls:
             if not is_optical:
                 # Radar format granule, just issue a warning
-                all_urls = ' '.join(keep_urls[granule_id])
+                all_urls = ' '.join(each[0] for each in keep_urls[granule_id])
                 logging.info(f"WARNING: multiple granules are detected for {each_url}: {all_urls}")
-                keep_urls[granule_id].append(each_url)
+                keep_urls[granule_id].append((each_url, url_proc_1, url_proc_2))
                 continue
 
             # Process optical granule
             # Flag if newly found URL should be kept
             keep_found_url = False
 
-            for found_url in keep_urls[granule_id]:
+            for _, found_proc_1, found_proc_2 in keep_urls[granule_id]:
                 # Check already found URLs for processing time
-                _, _, found_proc_1, _, _, found_proc_2, _ = \
-                    get_tokens_from_filename(found_url)
-
                 # If both granules have identical processing time,
                 # keep them both - granules might be in different projections,
                 # any other than target projection will be handled later
                 if url_proc_1 == found_proc_1 and \
                    url_proc_2 == found_proc_2:
-                    keep_urls[granule_id].append(each_url)
+                    keep_urls[granule_id].append((each_url, url_proc_1, url_proc_2))
                     keep_found_url = True
                     break
 
@@ -154,11 +248,8 @@ def skip_duplicate_granules(found_urls: list):
                 # Check if any of the found URLs have older processing time
                 # than newly found URL
                 remove_urls = []
-                for found_url in keep_urls[granule_id]:
+                for found_url, found_proc_1, found_proc_2 in keep_urls[granule_id]:
                     # Check already found URL for processing time
-                    _, _, found_proc_1, _, _, found_proc_2, _ = \
-                        get_tokens_from_filename(found_url)
-
                     if url_proc_1 >= found_proc_1 and \
                        url_proc_2 >= found_proc_2:
                         # The granule will need to be replaced with a newer
@@ -178,26 +269,55 @@ def skip_duplicate_granules(found_urls: list):
                     skipped_double_granules.extend(remove_urls)
 
                     # Remove older processed granules based on dates for "each_url"
-                    keep_urls[granule_id][:] = [each for each in keep_urls[granule_id] if each not in remove_urls]
+                    remove_urls = set(remove_urls)
+                    keep_urls[granule_id][:] = [each for each in keep_urls[granule_id] if each[0] not in remove_urls]
                     # Add new granule with newer processing date
-                    keep_urls[granule_id].append(each_url)
+                    keep_urls[granule_id].append((each_url, url_proc_1, url_proc_2))
 
                 else:
                     # New granule has older processing date, don't include
-                    logging.info(f"Skipping new {each_url} in favor of {keep_urls[granule_id]}")
+                    logging.info(f"Skipping new {each_url} in favor of {[each[0] for each in keep_urls[granule_id]]}")
                     skipped_double_granules.append(each_url)
 
         else:
             # This is a granule for new ID, append it to URLs to keep
-            keep_urls.setdefault(granule_id, []).append(each_url)
+            keep_urls.setdefault(granule_id, []).append((each_url, url_proc_1, url_proc_2))
 
     granules = []
     for each in keep_urls.values():
-        granules.extend(each)
+        granules.extend(each_url for each_url, _, _ in each)
 
     logging.info(f"Keeping {len(granules)} unique granules, skipping {len(skipped_double_granules)} granules")
     return granules, skipped_double_granules
 
+def glob_granules(s3, granules_dir: str, glob_pattern: str, num_workers: int = NUM_LIST_WORKERS):
+    """
+    Find granules that match glob pattern under granules_dir.
+
+    If the first component of the pattern is a sub-directory name (or a
+    pattern for it), list the matching sub-directories first and search each
+    of them concurrently, rather than listing all of granules_dir with
+    sequential requests.
+
+    num_workers: Number of sub-directories to search concurrently.
+    """
+    first_pattern, _, sub_pattern = glob_pattern.partition('/')
+
+    if len(sub_pattern) == 0 or '**' in first_pattern:
+        # Nothing to shard the search by
+        return s3.glob(f'{granules_dir}/{glob_pattern}')
+
+    sub_dirs = [
+        each['name'] for each in s3.ls(granules_dir, detail=True)
+        if each['type'] == 'directory' and fnmatch.fnmatchcase(os.path.basename(each['name'].rstrip('/')), first_pattern)
+    ]
+    logging.info(f"Searching {len(sub_dirs)} sub-directories of {granules_dir}")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        found_files = executor.map(lambda each_dir: s3.glob(f"{each_dir.rstrip('/')}/{sub_pattern}"), sub_dirs)
+
+        return sorted(itertools.chain.from_iterable(found_files))
+
 
 class memtracker:
 
@@ -206,23 +326,99 @@ class memtracker:
         if include_time:
             self.start_time = time.time()
         self.process = psutil.Process()
-        self.startrss = self.process.memory_info().rss
-        self.startvms = self.process.memory_info().vms
+        # Total physical memory to report memory usage percent for
+        self.total_memory = psutil.virtual_memory().total
+
+        meminfo = self.process.memory_info()
+        self.startrss = meminfo.rss
+        self.startvms = meminfo.vms
 
     def meminfo(self, message):
+        # Take one snapshot of the process memory per report
+        meminfo = self.process.memory_info()
+        # Same as self.process.memory_percent(), but for the snapshot
+        mem_percent = 100.0 * meminfo.rss / self.total_memory
+
         if self.output_time:
             time_elapsed_seconds = time.time() - self.start_time
-            print(f'{message:<30}:  time: {time_elapsed_seconds:8.2f} seconds    mem_percent {self.process.memory_percent()} ' +
-                    f'delrss={self.process.memory_info().rss - self.startrss:16,}    ' +
-                    f'delvms={self.process.memory_info().vms - self.startvms:16,}',
+            print(f'{message:<30}:  time: {time_elapsed_seconds:8.2f} seconds    mem_percent {mem_percent} ' +
+                    f'delrss={meminfo.rss - self.startrss:16,}    ' +
+                    f'delvms={meminfo.vms - self.startvms:16,}',
                     flush=True)
         else: # don't output time
-            print(f'{message:<30}:  delrss={self.process.memory_info().rss - self.startrss:16,}   mem_percent {self.process.memory_percent()} ' +
-                    f'delvms={self.process.memory_info().vms - self.startvms:16,}',
+            print(f'{message:<30}:  delrss={meminfo.rss - self.startrss:16,}   mem_percent {mem_percent} ' +
+                    f'delvms={meminfo.vms - self.startvms:16,}',
                     flush=True)
 
 # mt = memtracker()
 
+class FeatureStream:
+    """
+    Write geojson FeatureCollection to the file one feature at a time, so
+    there is no need to keep all features of the collection in memory.
+    Written content is identical to json.dump(geojson.FeatureCollection(features), outf).
+    """
+    HEADER = '{"type": "FeatureCollection", "features": ['
+    SEPARATOR = ', '
+    FOOTER = ']}'
+
+    def __init__(self, outf):
+        """
+        Initialize the object.
+        """
+        self.outf = outf
+        self.num_features = 0
+
+        self.outf.write(self.HEADER)
+
+    def write(self, feature):
+        """
+        Write feature to the file.
+        """
+        if self.num_features:
+            self.outf.write(self.SEPARATOR)
+
+        # ATTN: Use json.dumps() to write geojson to the file.
+        # Using geojson.dump() raises ValueError: Out of range float values are not JSON compliant: nan
+        # for dictionaries with nan's (newly introduced stable_shift
+        # can be set to NaN)
+        self.outf.write(json.dumps(feature))
+        self.num_features += 1
+
+    def close(self):
+        """
+        Finish FeatureCollection in the file.
+        """
+        self.outf.write(self.FOOTER)
+
+class NDJSONFeatureStream(FeatureStream):
+    """
+    Write features to the file as newline-delimited JSON: one feature per line,
+    so the file can be read one feature at a time. FeatureCollection envelope
+    is stored in the separate metadata file (see metadata()).
+    """
+    HEADER = ''
+    SEPARATOR = '\n'
+    FOOTER = '\n'
+
+    def close(self):
+        """
+        Terminate the last feature line, if any: a file without features
+        is empty rather than a single blank line.
+        """
+        if self.num_features:
+            super().close()
+
+    def metadata(self, features_filename: str):
+        """
+        FeatureCollection envelope for the features written to the file.
+        """
+        return {
+            'type': 'FeatureCollection',
+            'features_file': features_filename,
+            'num_features': self.num_features
+        }
+
 class GranuleCatalog:
     """
     Class to build ITS_LIVE granule catalog in geojson format for ingest by
@@ -233,6 +429,31 @@ class GranuleCatalog:
     EXCLUDE_GRANULES_FILE = None
     REMOVE_DUPLICATE_GRANULES = False
 
+    # Number of granules to catalog by each of the parallel tasks
+    NUM_GRANULES_PER_TASK = 50
+
+    # Number of granules to download concurrently within each of the parallel tasks
+    NUM_PREFETCH_GRANULES = 8
+
+    # Default size of the connection pool of S3 client: the pool is extended
+    # to fit all concurrent granule downloads of the task
+    S3_MAX_POOL_CONNECTIONS = 10
+
+    # Flag to write catalog files as newline-delimited JSON (one feature per line)
+    # along with the FeatureCollection metadata file, instead of geojson files
+    NDJSON = False
+
+    # Polygon ring (in counterclockwise order) as offsets within the unit square:
+    # ll, 3 points on bottom side, lr, 3 points on right side, ur, 3 points on
+    # top side, ul, 3 points on left side, ll. Every 4th row is a corner point.
+    _UNIT_PERIMETER = np.array([
+        [0.0,  0.0],  [0.25, 0.0],  [0.5, 0.0],  [0.75, 0.0],
+        [1.0,  0.0],  [1.0,  0.25], [1.0, 0.5],  [1.0,  0.75],
+        [1.0,  1.0],  [0.75, 1.0],  [0.5, 1.0],  [0.25, 1.0],
+        [0.0,  1.0],  [0.0,  0.75], [0.0, 0.5],  [0.0,  0.25],
+        [0.0,  0.0]
+    ], dtype=float)
+
     def __init__(self, granules_file: str, features_per_file: int, catalog_dir: str, start_index: int=0):
         """
         Initialize the object.
@@ -242,9 +463,9 @@ class GranuleCatalog:
         # read in granule file list from S3 file
         self.infiles = None
         logging.info(f"Opening granules file: {granules_file}")
-        with self.s3.open(granules_file, 'r') as ins3file:
-            self.infiles = json.load(ins3file)
-            logging.info(f"Loaded {len(self.infiles)} granules from '{granules_file}'")
+        # Read raw bytes with a single request and parse them without decoding to text first
+        self.infiles = _json.loads(self.s3.cat(granules_file))
+        logging.info(f"Loaded {len(self.infiles)} granules from '{granules_file}'")
 
         if GranuleCatalog.EXCLUDE_GRANULES_FILE is not None:
             # Exclude known granules from new catalog geojson files
@@ -252,12 +473,11 @@ class GranuleCatalog:
             exclude_file_path = os.path.join(catalog_dir, GranuleCatalog.EXCLUDE_GRANULES_FILE)
             logging.info(f"Opening file with granules to exclude: {exclude_file_path}")
 
-            with self.s3.open(exclude_file_path, 'r') as fhandle:
-                exclude_files = json.load(fhandle)
-                logging.info(f"Loaded {len(exclude_files)} granules from '{exclude_file_path}' to exclude ")
+            exclude_files = _json.loads(self.s3.cat(exclude_file_path))
+            logging.info(f"Loaded {len(exclude_files)} granules from '{exclude_file_path}' to exclude ")
 
-                self.infiles = list(set(self.infiles).difference(exclude_files))
-                logging.info(f"{len(self.infiles)} new granules to catalog")
+            self.infiles = list(set(self.infiles).difference(exclude_files))
+            logging.info(f"{len(self.infiles)} new granules to catalog")
 
         # Sort self.infiles to guarantee the same order of granules if have to pick the processing
         # somewhere in a middle (previous processing failed due to some exception)
@@ -286,54 +506,88 @@ class GranuleCatalog:
             return
 
         start = 0                              # Current start index into global list
-        read_num_files = 0                     # Number of read files within the block
         block_start = file_start_index         # Current start index for the block to write to file
         cum_read_num_files = file_start_index  # Cumulative number of processed granules
 
         base_dir = os.path.basename(granules_dir)
 
-        feature_list = []
+        # S3 client to read granules: each of the worker processes gets its own
+        # copy of the client, which is shared by the tasks of that process
+        s3 = s3fs.S3FileSystem(
+            anon=True,
+            config_kwargs={
+                'max_pool_connections': max(GranuleCatalog.S3_MAX_POOL_CONNECTIONS, GranuleCatalog.NUM_PREFETCH_GRANULES)
+            }
+        )
+
+        # Number of granules per catalog file: the file is complete once
+        # it has at least features_per_file granules
+        num_block_files = max(1, math.ceil(self.features_per_file / chunk_size)) * chunk_size
+
         while total_num_files > 0:
-            num_tasks = chunk_size if total_num_files > chunk_size else total_num_files
-
-            logging.info(f"Starting granules {start}:{start+num_tasks} out of {init_total_files} total granules")
-            tasks = [dask.delayed(GranuleCatalog.image_pair_feature_from_path)(each, self.s3) for each in self.infiles[start:start+num_tasks]]
-            results = None
-
-            with ProgressBar():
-                # Display progress bar
-                results = dask.compute(tasks,
-                                       scheduler="processes",
-                                       num_workers=num_dask_workers)
-
-            feature_list.extend(results[0])
-
-            total_num_files -= num_tasks
-            read_num_files += num_tasks
-            cum_read_num_files += num_tasks
-            start += num_tasks
-
-            # Check if need to write to the file:
-            if read_num_files >= self.features_per_file or total_num_files <= 0:
-                # Use sub-directory name of input path as base for output filename
-                featureColl = geojson.FeatureCollection(feature_list)
-                outfilename = f'imgpair_{base_dir}_{block_start}_{cum_read_num_files-1}.json'
-
-                with s3_out.open(f'{self.catalog_dir}/{outfilename}', 'w') as outf:
-                    # ATTN: Use shapely.geometry.mapping to write geojson to the file.
-                    # Using geojson.dump() raises ValueError: Out of range float values are not JSON compliant: nan
-                    # for dictionaries with nan's (newly introduced stable_shift
-                    # can be set to NaN)
-                    # WAS: geojson.dump(featureColl, outf)
-                    json.dump(mapping(featureColl), outf)
-
-                # mt.meminfo(f'wrote {args.catalog_dir}/{outfilename}')
-                logging.info(f'Wrote {self.catalog_dir}/{outfilename}')
-                feature_list = []
-                featureColl = None
-
-                read_num_files = 0
-                block_start = cum_read_num_files
+            # Use sub-directory name of input path as base for output filename
+            block_end = block_start + min(num_block_files, total_num_files)
+            outfilebase = f'imgpair_{base_dir}_{block_start}_{block_end-1}'
+            outfilename = f'{outfilebase}.ndjson' if GranuleCatalog.NDJSON else f'{outfilebase}.json'
+            outfilepath = f'{self.catalog_dir}/{outfilename}'
+
+            # Stream features of the block to the file as they are created
+            outf = s3_out.open(outfilepath, 'w')
+            try:
+                feature_stream = NDJSONFeatureStream(outf) if GranuleCatalog.NDJSON else FeatureStream(outf)
+
+                while cum_read_num_files < block_end:
+                    num_tasks = chunk_size if total_num_files > chunk_size else total_num_files
+
+                    logging.info(f"Starting granules {start}:{start+num_tasks} out of {init_total_files} total granules")
+                    tasks = [
+                        dask.delayed(GranuleCatalog.image_pair_features_from_paths)(
+                            self.infiles[each_start:min(each_start+GranuleCatalog.NUM_GRANULES_PER_TASK, start+num_tasks)],
+                            s3,
+                            GranuleCatalog.NUM_PREFETCH_GRANULES
+                        ) for each_start in range(start, start+num_tasks, GranuleCatalog.NUM_GRANULES_PER_TASK)
+                    ]
+                    results = None
+
+                    with ProgressBar():
+                        # Display progress bar
+                        # Each task downloads its granules by threads, but parses them
+                        # with h5py, which serializes all calls within the process
+                        # behind a global lock: use processes to parse granules in parallel
+                        results = dask.compute(tasks,
+                                               scheduler="processes",
+                                               num_workers=num_dask_workers)
+
+                    for each_features in results[0]:
+                        for each_feature in each_features:
+                            feature_stream.write(each_feature)
+
+                    results = None
+
+                    total_num_files -= num_tasks
+                    cum_read_num_files += num_tasks
+                    start += num_tasks
+
+                feature_stream.close()
+                outf.close()
+
+            except BaseException:
+                # Don't leave incomplete catalog file behind
+                outf.close()
+                s3_out.rm(outfilepath)
+                raise
+
+            # mt.meminfo(f'wrote {args.catalog_dir}/{outfilename}')
+            logging.info(f'Wrote {outfilepath}')
+
+            if GranuleCatalog.NDJSON:
+                metafilepath = f'{self.catalog_dir}/{outfilebase}.meta.json'
+                with s3_out.open(metafilepath, 'w') as outf:
+                    json.dump(feature_stream.metadata(outfilename), outf)
+
+                logging.info(f'Wrote {metafilepath}')
+
+            block_start = cum_read_num_files
 
     @staticmethod
     def get_h5_attribute_value(h5_attr):
@@ -356,7 +610,53 @@ class GranuleCatalog:
         return value
 
     @staticmethod
-    def image_pair_feature_from_path(infilewithpath: str, s3):
+    @functools.lru_cache(maxsize=512)
+    def get_transformer(epsgcode):
+        """
+        Get transformer from granule's projection to lon/lat coordinates.
+        Transformers are cached per EPSG code within each worker process.
+        """
+        return pyproj.Transformer.from_crs(f"EPSG:{epsgcode}", "EPSG:4326", always_xy=True) # ensure lonlat output order
+
+    @staticmethod
+    def read_s3_bytes(infilewithpath: str, s3):
+        """
+        Read the whole granule from S3 bucket into memory with a single GET request.
+        """
+        return io.BytesIO(s3.cat(f"s3://{infilewithpath}"))
+
+    @staticmethod
+    def image_pair_features_from_paths(infileswithpath: list, s3, concurrency: int):
+        """
+        Create features for the granules: keep up to "concurrency" granules
+        downloading ahead of the granule being cataloged.
+        """
+        features = []
+        infiles = iter(infileswithpath)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = collections.deque(
+                (each, executor.submit(GranuleCatalog.read_s3_bytes, each, s3))
+                for each in itertools.islice(infiles, concurrency)
+            )
+
+            while len(pending):
+                each_file, each_future = pending.popleft()
+
+                next_file = next(infiles, None)
+                if next_file is not None:
+                    pending.append((next_file, executor.submit(GranuleCatalog.read_s3_bytes, next_file, s3)))
+
+                with each_future.result() as fhandle:
+                    features.append(GranuleCatalog.image_pair_feature(each_file, fhandle))
+
+        return features
+
+    @staticmethod
+    def image_pair_feature(infilewithpath: str, ins3):
+        """
+        Create feature for the granule from its opened file object.
+        """
         filename_tokens = infilewithpath.split('/')
         directory = '/'.join(filename_tokens[1:-1])
         filename = filename_tokens[-1]
@@ -368,11 +668,13 @@ class GranuleCatalog:
         stable_shift_value = np.nan
         v_error_max = np.nan
 
-        with s3.open(f"s3://{infilewithpath}", "rb") as ins3:
-            inh5 = h5py.File(ins3, mode = 'r')
-            # netCDF4/HDF5 cf 1.6 has x and y vectors of array pixel CENTERS
-            xvals = np.array(inh5.get('x'))
-            yvals = np.array(inh5.get('y'))
+        with h5py.File(ins3, mode = 'r') as inh5:
+            # netCDF4/HDF5 cf 1.6 has x and y vectors of array pixel CENTERS:
+            # only first and last values are used, don't read whole vectors
+            x_var = inh5['x']
+            y_var = inh5['y']
+            xvals = np.array([x_var[0], x_var[-1]])
+            yvals = np.array([y_var[0], y_var[-1]])
 
             # Extract projection variable
             projection_cf = None
@@ -395,8 +697,8 @@ class GranuleCatalog:
             except Exception as exc:
                 raise RuntimeError(f'Error processing {infilewithpath}: img_pair_info.{k}: {imginfo_attrs[k]} type={type(imginfo_attrs[k])} exc={exc} ({imginfo_attrs})')
 
-            num_pix_x = len(xvals)
-            num_pix_y = len(yvals)
+            num_pix_x = x_var.shape[0]
+            num_pix_y = y_var.shape[0]
 
             minval_x, pix_size_x, rot_x_ignored, maxval_y, rot_y_ignored, pix_size_y = [float(x) for x in projection_cf.attrs['GeoTransform'].split()]
 
@@ -414,8 +716,6 @@ class GranuleCatalog:
                 # stable_shift = rms of vx.stable_shift and vy.stable_shift
                 stable_shift_value = np.sqrt((vx_stable_shift**2 + vy_stable_shift**2)/2)
 
-            inh5.close()
-
         # NOTE: these are pixel center values, need to modify by half the grid size to get bounding box/geotransform values
         projection_cf_minx = xvals[0] - pix_size_x/2.0
         projection_cf_maxx = xvals[-1] + pix_size_x/2.0
@@ -423,75 +723,62 @@ class GranuleCatalog:
         projection_cf_maxy = yvals[0] - pix_size_y/2.0  # pix_size_y is negative!
 
 
-        transformer = pyproj.Transformer.from_crs(f"EPSG:{epsgcode}", "EPSG:4326", always_xy=True) # ensure lonlat output order
+        transformer = GranuleCatalog.get_transformer(epsgcode)
 
-        ll_lonlat = np.round(transformer.transform(projection_cf_minx,projection_cf_miny),decimals = 7).tolist()
-        lr_lonlat = np.round(transformer.transform(projection_cf_maxx,projection_cf_miny),decimals = 7).tolist()
-        ur_lonlat = np.round(transformer.transform(projection_cf_maxx,projection_cf_maxy),decimals = 7).tolist()
-        ul_lonlat = np.round(transformer.transform(projection_cf_minx,projection_cf_maxy),decimals = 7).tolist()
+        if GranuleCatalog.FIVE_POINTS_PER_SIDE:
+            unit_perimeter = GranuleCatalog._UNIT_PERIMETER
+
+        else:
+            # only the corner points
+            unit_perimeter = GranuleCatalog._UNIT_PERIMETER[::4]
+
+        xs = projection_cf_minx + unit_perimeter[:, 0]*(projection_cf_maxx - projection_cf_minx)
+        ys = projection_cf_miny + unit_perimeter[:, 1]*(projection_cf_maxy - projection_cf_miny)
 
         # find center lon lat for inclusion in feature (to determine lon lat grid cell directory)
         #     projection_cf_centerx = (xvals[0] + xvals[-1])/2.0
         #     projection_cf_centery = (yvals[0] + yvals[-1])/2.0
-        center_lonlat = np.round(transformer.transform((xvals[0] + xvals[-1])/2.0,(yvals[0] + yvals[-1])/2.0 ),decimals = 7).tolist()
+        # Transform the polygon ring and its center with a single call
+        xs = np.append(xs, (xvals[0] + xvals[-1])/2.0)
+        ys = np.append(ys, (yvals[0] + yvals[-1])/2.0)
 
-        if GranuleCatalog.FIVE_POINTS_PER_SIDE:
-            fracs = [0.25, 0.5, 0.75]
-            polylist = [] # ring in counterclockwise order
-
-            polylist.append(ll_lonlat)
-            dx = projection_cf_maxx - projection_cf_minx
-            dy = projection_cf_miny - projection_cf_miny
-            for frac in fracs:
-                polylist.append(np.round(transformer.transform(projection_cf_minx + (frac * dx), projection_cf_miny + (frac * dy)),decimals = 7).tolist())
-
-            polylist.append(lr_lonlat)
-            dx = projection_cf_maxx - projection_cf_maxx
-            dy = projection_cf_maxy - projection_cf_miny
-            for frac in fracs:
-                polylist.append(np.round(transformer.transform(projection_cf_maxx + (frac * dx), projection_cf_miny + (frac * dy)),decimals = 7).tolist())
-
-            polylist.append(ur_lonlat)
-            dx = projection_cf_minx - projection_cf_maxx
-            dy = projection_cf_maxy - projection_cf_maxy
-            for frac in fracs:
-                polylist.append(np.round(transformer.transform(projection_cf_maxx + (frac * dx), projection_cf_maxy + (frac * dy)),decimals = 7).tolist())
-
-            polylist.append(ul_lonlat)
-            dx = projection_cf_minx - projection_cf_minx
-            dy = projection_cf_miny - projection_cf_maxy
-            for frac in fracs:
-                polylist.append(np.round(transformer.transform(projection_cf_minx + (frac * dx), projection_cf_maxy + (frac * dy)),decimals = 7).tolist())
-
-            polylist.append(ll_lonlat)
+        lons, lats = transformer.transform(xs, ys)
+        lonlat = np.round(np.column_stack([lons, lats]), decimals = 7).tolist()
 
-        else:
-            # only the corner points
-            polylist = [ ll_lonlat, lr_lonlat, ur_lonlat, ul_lonlat, ll_lonlat ]
+        polylist = lonlat[:-1] # ring in counterclockwise order
+        center_lonlat = lonlat[-1]
 
-        poly = geojson.Polygon([polylist])
+        # Build geojson objects as plain dictionaries: geojson.Polygon() and
+        # geojson.Feature() validate and copy the data for every granule.
+        # Polygon coordinates are rounded to the default precision of geojson.Polygon()
+        poly = {
+            'type': 'Polygon',
+            'coordinates': [[[round(lon, GEOJSON_PRECISION), round(lat, GEOJSON_PRECISION)] for lon, lat in polylist]]
+        }
 
         middate = img_pair_info_dict['date_center']
         deldays = img_pair_info_dict['date_dt']
         percent_valid_pix = img_pair_info_dict['roi_valid_percentage']
 
-        feat = geojson.Feature( geometry=poly,
-                                properties={
-                                            'filename': filename,
-                                            'directory': directory,
-                                            'middate':middate,
-                                            'deldays':deldays,
-                                            'percent_valid_pix': percent_valid_pix,
-                                            'center_lonlat':center_lonlat,
-                                            'data_epsg':epsgcode,
-                                            # date_deldays_strrep is a string version of center date and time interval that will sort by date and then by interval length (shorter intervals first) - relies on "string" comparisons by byte
-                                            'date_deldays_strrep': img_pair_info_dict['date_center'] + f"{img_pair_info_dict['date_dt']:07.1f}".replace('.',''),
-                                            'img_pair_info_dict': img_pair_info_dict,
-                                            'v_error_max': v_error_max,
-                                            'stable_shift': stable_shift_value,
-                                            'version': data_version
-                                            }
-                                )
+        feat = {
+            'type': 'Feature',
+            'geometry': poly,
+            'properties': {
+                'filename': filename,
+                'directory': directory,
+                'middate':middate,
+                'deldays':deldays,
+                'percent_valid_pix': percent_valid_pix,
+                'center_lonlat':center_lonlat,
+                'data_epsg':epsgcode,
+                # date_deldays_strrep is a string version of center date and time interval that will sort by date and then by interval length (shorter intervals first) - relies on "string" comparisons by byte
+                'date_deldays_strrep': img_pair_info_dict['date_center'] + f"{img_pair_info_dict['date_dt']:07.1f}".replace('.',''),
+                'img_pair_info_dict': img_pair_info_dict,
+                'v_error_max': v_error_max,
+                'stable_shift': stable_shift_value,
+                'version': data_version
+            }
+        }
         return(feat)
 
 if __name__ == '__main__':
@@ -592,6 +879,21 @@ if __name__ == '__main__':
                         default=4,
                         help='Number of Dask parallel workers [%(default)d]')
 
+    parser.add_argument('-granules_per_task', type=int,
+                        default=GranuleCatalog.NUM_GRANULES_PER_TASK,
+                        help='Number of granules to catalog by each of Dask parallel tasks [%(default)d]')
+
+    parser.add_argument('-prefetch_granules', type=int,
+                        default=GranuleCatalog.NUM_PREFETCH_GRANULES,
+                        help='Number of granules to download concurrently within each of Dask parallel tasks [%(default)d]')
+
+    parser.add_argument('-ndjson', action='store_true',
+                        help='Write catalog files as newline-delimited JSON (one feature per line) along with FeatureCollection metadata file, instead of geojson FeatureCollection files')
+
+    parser.add_argument('-list_workers', type=int,
+                        default=NUM_LIST_WORKERS,
+                        help='Number of granule sub-directories to search concurrently when building a list of granules [%(default)d]')
+
 
     args = parser.parse_args()
 
@@ -599,6 +901,9 @@ if __name__ == '__main__':
     GranuleCatalog.DATA_VERSION = args.data_version
     GranuleCatalog.EXCLUDE_GRANULES_FILE = args.exclude_granules_file
     GranuleCatalog.REMOVE_DUPLICATE_GRANULES = args.remove_duplicate_granules
+    GranuleCatalog.NUM_GRANULES_PER_TASK = args.granules_per_task
+    GranuleCatalog.NUM_PREFETCH_GRANULES = args.prefetch_granules
+    GranuleCatalog.NDJSON = args.ndjson
 
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
                         datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
@@ -633,7 +938,7 @@ if __name__ == '__main__':
         # use a glob to list directory
         logging.info(f"Creating a list of granules to catalog")
         logging.info(f"Glob {granules_dir}/{args.glob}")
-        infilelist = s3_out.glob(f'{granules_dir}/{args.glob}')
+        infilelist = glob_granules(s3_out, granules_dir, args.glob, args.list_workers)
         logging.info(f"Got {len(infilelist)} granules")
 
         # check for '_P' in filename - filters out temp.nc files that can be left by bad transfers
@@ -17,24 +17,135 @@ vs. 1.5 minutes to upload the file from laptop to the S3 bucket.
 Authors: Masha Liukis, Alex Gardner
 """
 import argparse
-import dask
-from dask.diagnostics import ProgressBar
+import collections
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import hashlib
+import io
+import itertools
 import logging
 import numpy as np
 import os
+import pandas as pd
 import s3fs
 import shutil
 import subprocess
+import threading
 import xarray as xr
 import zarr
 
 from itslive_composite import SensorExcludeFilter, MissionSensor, Output
 from itscube import ITSCube
-from itscube_types import DataVars, Coords
+from itscube_types import DataVars, Coords, BinaryFlag
 
 NC_ENGINE = 'h5netcdf'
 
 
+class GranuleCache:
+    """
+    Size-bounded local cache of S1 granules: neighboring datacubes share the
+    same granules, so each of the granules is downloaded from S3 bucket only
+    once as long as it stays in the cache. Least recently used granules are
+    evicted based on modification time of the cached files.
+    """
+    # Extension for granules stored in the cache
+    FILE_EXT = '.nc'
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Initialize object.
+
+        Args:
+            cache_dir (str): Local directory to store cached granules to.
+            max_bytes (int): Maximum size in bytes of all cached granules.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        # Datacubes are processed by parallel threads which share the cache
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+
+        # Remove temporary files of the downloads interrupted by previous runs
+        # (see get()): these are never used and not accounted for by the cache
+        for each in os.listdir(self.cache_dir):
+            if GranuleCache.FILE_EXT + '.' in each and not each.endswith(GranuleCache.FILE_EXT):
+                os.remove(os.path.join(self.cache_dir, each))
+
+        # Account for granules cached by previous runs
+        self.num_bytes = sum(os.lstat(each).st_size for each in self.cached_files())
+
+        logging.info(f"Granule cache {self.cache_dir}: {self.num_bytes} bytes")
+
+    def cached_files(self):
+        """
+        Return paths of all granules stored in the cache.
+        """
+        return [
+            os.path.join(self.cache_dir, each)
+            for each in os.listdir(self.cache_dir) if each.endswith(GranuleCache.FILE_EXT)
+        ]
+
+    def get(self, granule_s3: str, s3: s3fs.S3FileSystem):
+        """
+        Return content of the granule: read it from the cache if it's been
+        downloaded already, download it from S3 bucket and cache it otherwise.
+        """
+        cache_file = os.path.join(
+            self.cache_dir,
+            hashlib.md5(granule_s3.encode()).hexdigest() + GranuleCache.FILE_EXT
+        )
+
+        try:
+            with open(cache_file, 'rb') as fh:
+                content = fh.read()
+
+            # Mark granule as the most recently used
+            os.utime(cache_file)
+            return content
+
+        except FileNotFoundError:
+            # Granule is not cached or has been evicted by another thread
+            pass
+
+        content = s3.cat(granule_s3)
+
+        # Write to a temporary file first, so other threads never read partially written granule
+        tmp_file = f'{cache_file}.{threading.get_ident()}'
+        with open(tmp_file, 'wb') as fh:
+            fh.write(content)
+
+        with self.lock:
+            if os.path.exists(cache_file):
+                # Another thread has cached the same granule in the meantime
+                os.remove(tmp_file)
+
+            else:
+                os.replace(tmp_file, cache_file)
+                self.num_bytes += len(content)
+
+                if self.num_bytes > self.max_bytes:
+                    self.evict()
+
+        return content
+
+    def evict(self):
+        """
+        Remove least recently used granules until the cache fits into its size
+        limit. The caller must hold the lock.
+        """
+        files_stat = [(each, os.lstat(each)) for each in self.cached_files()]
+        files_stat.sort(key=lambda x: x[1].st_mtime)
+
+        for each_file, each_stat in files_stat:
+            if self.num_bytes <= self.max_bytes:
+                break
+
+            os.remove(each_file)
+            self.num_bytes -= each_stat.st_size
+
+
 class FixDatacubes:
     """
     Class to apply fixes to ITS_LIVE datacubes:
@@ -46,7 +157,30 @@ class FixDatacubes:
     S3_PREFIX = 's3://'
     DRY_RUN = False
 
-    def __init__(self, bucket: str, bucket_dir: str, target_bucket_dir: str, local_original_cube_dir: str, local_dir: str):
+    # Report min/max of original M11/M12 values of the cube: requires a full
+    # scan of the values, so it's disabled by default
+    LOG_STATS = False
+
+    # Number of S1 granules to download concurrently when restoring M11/M12 values of the cube
+    NUM_PREFETCH_GRANULES = 32
+
+    # Default size of the connection pool of S3 client: the pool is extended
+    # to fit all concurrent granule downloads
+    S3_MAX_POOL_CONNECTIONS = 10
+
+    # Local cache of S1 granules shared by all datacubes (GranuleCache),
+    # granules are always downloaded from S3 bucket if not set
+    GRANULE_CACHE = None
+
+    def __init__(
+        self,
+        bucket: str,
+        bucket_dir: str,
+        target_bucket_dir: str,
+        local_original_cube_dir: str,
+        local_dir: str,
+        num_dask_workers: int
+    ):
         """
         Initialize object.
 
@@ -56,8 +190,17 @@ class FixDatacubes:
             target_bucket_dir (str): AWS S3 directgory to store corrected datacubes.
             local_original_cube_dir (str): Local directory to store downloaded original datacubes to fix.
             local_dir (str): Local directory to save corrected cubes to.
+            num_dask_workers (int): Number of datacubes to fix in parallel.
         """
-        self.s3 = s3fs.S3FileSystem(anon=True)
+        # Datacubes are processed by parallel threads, which share the same S3
+        # client to read granules: extend its connection pool to fit concurrent
+        # granule downloads of all threads
+        self.s3 = s3fs.S3FileSystem(
+            anon=True,
+            config_kwargs={
+                'max_pool_connections': max(FixDatacubes.S3_MAX_POOL_CONNECTIONS, num_dask_workers*FixDatacubes.NUM_PREFETCH_GRANULES)
+            }
+        )
         self.bucket_dir = bucket_dir
         self.target_bucket_dir = target_bucket_dir
 
@@ -107,8 +250,15 @@ class FixDatacubes:
                 self.target_bucket_dir,
                 self.local_original_cube_dir,
                 self.local_dir,
-                self.s3
+                self.s3,
+                FixDatacubes.NUM_PREFETCH_GRANULES
             )
+            msgs.extend(FixDatacubes.upload(
+                each_cube,
+                self.bucket_dir,
+                self.target_bucket_dir,
+                self.local_dir
+            ))
             logging.info("\n-->".join(msgs))
 
     def __call__(self, num_dask_workers: int, start_cube: int = 0):
@@ -124,38 +274,184 @@ class FixDatacubes:
             logging.info("Nothing to fix, exiting.")
             return
 
-        # For debugging
-        num_to_fix = 1
-
-        while num_to_fix > 0:
-            num_tasks = num_dask_workers if num_to_fix > num_dask_workers else num_to_fix
-
-            logging.info(f"Starting tasks {start}:{start+num_tasks}")
-            tasks = [
-                dask.delayed(FixDatacubes.all)(
-                    each,
-                    self.bucket_dir,
-                    self.target_bucket_dir,
-                    self.local_original_cube_dir,
-                    self.local_dir,
-                    self.s3
-                ) for each in self.all_zarr_datacubes[start:start+num_tasks]
+        # Stream datacubes through two stages: fix datacubes by parallel threads and
+        # upload each of the fixed datacubes as soon as it's ready, so uploads
+        # overlap with fixing of the next datacubes instead of waiting for
+        # the whole batch of datacubes to be processed
+        logging.info(f"Starting tasks {start}:{start+num_to_fix}")
+
+        with ThreadPoolExecutor(max_workers=num_dask_workers) as fix_executor, \
+                ThreadPoolExecutor(max_workers=num_dask_workers) as upload_executor:
+            cubes = iter(self.all_zarr_datacubes[start:start+num_to_fix])
+            fix_futures = {}
+            pending_uploads = collections.deque()
+
+            while True:
+                # Keep up to "num_dask_workers" datacubes being fixed
+                for each_cube in itertools.islice(cubes, num_dask_workers - len(fix_futures)):
+                    each_future = fix_executor.submit(
+                        FixDatacubes.all,
+                        each_cube,
+                        self.bucket_dir,
+                        self.target_bucket_dir,
+                        self.local_original_cube_dir,
+                        self.local_dir,
+                        self.s3,
+                        FixDatacubes.NUM_PREFETCH_GRANULES
+                    )
+                    fix_futures[each_future] = each_cube
+
+                if len(fix_futures) == 0:
+                    break
+
+                done, _ = wait(fix_futures, return_when=FIRST_COMPLETED)
+
+                for each_future in done:
+                    each_cube = fix_futures.pop(each_future)
+                    logging.info("\n-->".join(each_future.result()))
+
+                    pending_uploads.append(
+                        upload_executor.submit(
+                            FixDatacubes.upload,
+                            each_cube,
+                            self.bucket_dir,
+                            self.target_bucket_dir,
+                            self.local_dir
+                        )
+                    )
+
+                # Don't get ahead of uploads to limit local disk space used by fixed datacubes
+                while len(pending_uploads) > num_dask_workers:
+                    logging.info("\n-->".join(pending_uploads.popleft().result()))
+
+            for each_future in pending_uploads:
+                logging.info("\n-->".join(each_future.result()))
+
+    @staticmethod
+    def upload(cube_url: str, cube_bucket_dir: str, target_bucket_dir: str, local_dir: str):
+        """
+        Copy fixed datacube to S3 bucket's new location and remove its local copy.
+        """
+        msgs = []
+
+        if FixDatacubes.DRY_RUN:
+            return msgs
+
+        env_copy = os.environ.copy()
+        fixed_file = os.path.join(local_dir, os.path.basename(cube_url))
+
+        if os.path.exists(fixed_file):
+            # Use "subprocess" as s3fs.S3FileSystem leaves unclosed connections
+            # resulting in as many error messages as there are files in Zarr store
+            # to copy
+            target_url = cube_url.replace(cube_bucket_dir, target_bucket_dir)
+
+            if not target_url.startswith(FixDatacubes.S3_PREFIX):
+                target_url = FixDatacubes.S3_PREFIX + target_url
+
+            command_line = [
+                "aws", "s3", "cp", "--recursive", "--only-show-errors",
+                fixed_file,
+                target_url,
+                "--acl", "bucket-owner-full-control"
             ]
-            results = None
 
-            with ProgressBar():
-                # Display progress bar
-                results = dask.compute(
-                    tasks,
-                    scheduler="processes",
-                    num_workers=num_dask_workers
-                )
+            msgs.append(' '.join(command_line))
 
-            for each_result in results[0]:
-                logging.info("\n-->".join(each_result))
+            command_return = subprocess.run(
+                command_line,
+                env=env_copy,
+                check=False,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+            )
+            if command_return.returncode != 0:
+                msgs.append(f"ERROR: Failed to copy {fixed_file} to {target_url}: {command_return.stdout}")
 
-            num_to_fix -= num_tasks
-            start += num_tasks
+            msgs.append(f"Removing local {fixed_file}")
+            shutil.rmtree(fixed_file)
+
+        return msgs
+
+    @staticmethod
+    def read_s3_bytes(granule_s3: str, s3: s3fs.S3FileSystem):
+        """
+        Read the whole granule from S3 bucket into memory with a single GET request,
+        or from the local granule cache if it's enabled.
+        """
+        if FixDatacubes.GRANULE_CACHE is not None:
+            return io.BytesIO(FixDatacubes.GRANULE_CACHE.get(granule_s3, s3))
+
+        return io.BytesIO(s3.cat(granule_s3))
+
+    @staticmethod
+    def prefetch_granules(granules_s3: list, s3: s3fs.S3FileSystem, concurrency: int):
+        """
+        Generator of in-memory granules in the same order as granules_s3: keep up
+        to "concurrency" granules downloading ahead of the granule being consumed.
+        """
+        granules = iter(granules_s3)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = collections.deque(
+                executor.submit(FixDatacubes.read_s3_bytes, each, s3)
+                for each in itertools.islice(granules, concurrency)
+            )
+
+            while len(pending):
+                each_future = pending.popleft()
+
+                next_granule = next(granules, None)
+                if next_granule is not None:
+                    pending.append(executor.submit(FixDatacubes.read_s3_bytes, next_granule, s3))
+
+                yield each_future.result()
+
+    @staticmethod
+    def crop_slice(mask: np.ndarray):
+        """
+        Convert mask of monotonic granule coordinates that fall within the cube
+        polygon into the slice of the cells.
+        """
+        cells = np.flatnonzero(mask)
+
+        if cells.size == 0:
+            return slice(0, 0)
+
+        return slice(cells[0], cells[-1] + 1)
+
+    @staticmethod
+    def unchanged_vars(ds: xr.Dataset, cube_store: str):
+        """
+        Identify data variables that are stored in the original datacube with the
+        same chunking, compression and data type as required by the fixed datacube:
+        chunks of such variables can be copied to the fixed datacube as is.
+
+        ds: Datacube with encoding settings of the fixed datacube.
+        cube_store: Local Zarr store of the original datacube.
+        """
+        cube_group = zarr.open_consolidated(cube_store, mode='r')
+
+        unchanged = []
+        for each_var in ds.data_vars:
+            if each_var not in cube_group:
+                # New data variable
+                continue
+
+            zarr_var = cube_group[each_var]
+            encoding = ds[each_var].encoding
+
+            if Output.CHUNKS_ATTR not in encoding or Output.COMPRESSOR_ATTR not in encoding:
+                # Let xarray pick up storage settings
+                continue
+
+            if tuple(encoding[Output.CHUNKS_ATTR]) == zarr_var.chunks and \
+                encoding[Output.COMPRESSOR_ATTR] == zarr_var.compressor and \
+                np.dtype(encoding.get(Output.DTYPE_ATTR, zarr_var.dtype)) == zarr_var.dtype and \
+                    encoding.get('filters') == zarr_var.filters:
+                unchanged.append(each_var)
+
+        return unchanged
 
     @staticmethod
     def all(
@@ -164,10 +460,13 @@ class FixDatacubes:
         target_bucket_dir: str,
         local_original_cube_dir: str,
         local_dir: str,
-        s3: s3fs.S3FileSystem
+        s3: s3fs.S3FileSystem,
+        num_prefetch_granules: int
     ):
         """
-        Fix datacubes and copy them to S3 bucket's new location.
+        Fix datacube and store it locally: FixDatacubes.upload() copies it to S3 bucket's new location.
+
+        num_prefetch_granules: Number of S1 granules to download concurrently.
         """
         msgs = [f'Processing {cube_url}']
 
@@ -183,6 +482,8 @@ class FixDatacubes:
         # s3 =
         #    max_concurrent_requests = 100
         #
+        # Report errors only: otherwise AWS CLI reports progress for each of
+        # the thousands of Zarr chunk files, and all of it is captured in memory
         env_copy = os.environ.copy()
         source_url = cube_url
         if not cube_url.startswith(ITSCube.S3_PREFIX):
@@ -190,7 +491,7 @@ class FixDatacubes:
 
         local_original_cube = os.path.join(local_original_cube_dir, cube_basename)
         command_line = [
-            "awsv2", "s3", "cp", "--recursive",
+            "awsv2", "s3", "cp", "--recursive", "--only-show-errors",
             source_url,
             local_original_cube
         ]
@@ -227,47 +528,75 @@ class FixDatacubes:
             sensors = ds[DataVars.ImgPairInfo.SATELLITE_IMG1].values
             sensors_str = SensorExcludeFilter.map_sensor_to_group(sensors)
 
-            s1_mask = (sensors_str == MissionSensor.SENTINEL1.mission)
-            msgs.append(f'Identified {np.sum(s1_mask)} S1 layers in the cube')
-
-            # Number of S1 layers in the datacube
-            num_s1_layers = np.sum(s1_mask)
+            # Indices and number of S1 layers in the datacube
+            s1_indices = np.flatnonzero(sensors_str == MissionSensor.SENTINEL1.mission)
+            num_s1_layers = s1_indices.size
+            msgs.append(f'Identified {num_s1_layers} S1 layers in the cube')
 
             ascending_img1 = np.full((len(ds.mid_date)), ascending_fill_value, dtype=np.uint8)
             ascending_img2 = np.full((len(ds.mid_date)), ascending_fill_value, dtype=np.uint8)
 
             if num_s1_layers:
-                mask_i = np.where(s1_mask == True)
-
                 # Need to load all of M11/M12 data values in order to update them. Otherwise it silently ignores values when updating (xarray bug?)
+                # Restore values directly in the loaded arrays to avoid xarray
+                # label alignment for each of the granules
+                m_arrays = {}
                 for each_var in [DataVars.M11, DataVars.M12]:
                     m_values = ds[each_var].values
-                    msgs.append(f'cube {each_var}: min={np.nanmin(m_values)} max={np.nanmax(m_values)}')
 
-                # If there are no S1 granules, we still want to rechunk 'mid_date' coordinate
-                for each_index in mask_i[0]:
-                    # Read URL of the granule. For example, granules paths will be in the format:
-                    # https://its-live-data.s3.amazonaws.com/velocity_image_pair/sentinel1/v02/N70W060/S1A_IW_SLC__1SSH_20160728T113645_20160728T113712_012348_0133B2_74C0_X_S1A_IW_SLC__1SSH_20160809T113646_20160809T113713_012523_013989_2C50_G0120V02_P030.nc
-                    granule = str(ds.granule_url[each_index].values)
+                    if FixDatacubes.LOG_STATS:
+                        msgs.append(f'cube {each_var}: min={np.nanmin(m_values)} max={np.nanmax(m_values)}')
 
-                    each_granule_s3 = granule.replace('https://', '')
-                    each_granule_s3 = each_granule_s3.replace('.s3.amazonaws.com', '')
-                    # If using new temporary location of restored S1 granules
-                    # each_granule_s3 = each_granule_s3.replace('/sentinel1/', '/sentinel1-restoredM/')
+                    m_arrays[each_var] = m_values
 
+                cube_x_index = pd.Index(x_values)
+                cube_y_index = pd.Index(y_values)
+
+                # Flight directions of both images of each S1 granule
+                flight_direction_img1 = []
+                flight_direction_img2 = []
+
+                # If there are no S1 granules, we still want to rechunk 'mid_date' coordinate
+                # Read URLs of all S1 granules at once. For example, granules paths will be in the format:
+                # https://its-live-data.s3.amazonaws.com/velocity_image_pair/sentinel1/v02/N70W060/S1A_IW_SLC__1SSH_20160728T113645_20160728T113712_012348_0133B2_74C0_X_S1A_IW_SLC__1SSH_20160809T113646_20160809T113713_012523_013989_2C50_G0120V02_P030.nc
+                granules = ds[DataVars.URL].values[s1_indices].astype(str)
+
+                granules_s3 = np.char.replace(granules, 'https://', '')
+                granules_s3 = np.char.replace(granules_s3, '.s3.amazonaws.com', '')
+                # If using new temporary location of restored S1 granules
+                # granules_s3 = np.char.replace(granules_s3, '/sentinel1/', '/sentinel1-restoredM/')
+                granules_s3 = granules_s3.tolist()
+
+                # Download granules concurrently while restoring values from already downloaded ones
+                for each_index, each_granule_s3, each_fhandle in zip(
+                    s1_indices,
+                    granules_s3,
+                    FixDatacubes.prefetch_granules(granules_s3, s3, num_prefetch_granules)
+                ):
                     # Open the granule
-                    with s3.open(each_granule_s3, mode='rb') as fhandle:
+                    with each_fhandle as fhandle:
+                        # Don't load the whole granule: only M11/M12 values within
+                        # the cube polygon are read from the file
                         with xr.open_dataset(fhandle, engine=NC_ENGINE) as granule_ds:
-                            granule_ds = granule_ds.load()
-
                             msgs.append(f'Granule for index={each_index}: {each_granule_s3}; date_updated: {granule_ds.attrs["date_updated"]}')
 
-                            # Zoom into cube polygon
-                            mask_x = (granule_ds.x >= grid_x_min) & (granule_ds.x <= grid_x_max)
-                            mask_y = (granule_ds.y >= grid_y_min) & (granule_ds.y <= grid_y_max)
-                            mask = (mask_x & mask_y)
+                            # Zoom into cube polygon: granule x/y coordinates are monotonic,
+                            # so cells within the cube polygon form contiguous ranges
+                            granule_x = granule_ds.x.values
+                            granule_y = granule_ds.y.values
+
+                            x_cells = FixDatacubes.crop_slice((granule_x >= grid_x_min) & (granule_x <= grid_x_max))
+                            y_cells = FixDatacubes.crop_slice((granule_y >= grid_y_min) & (granule_y <= grid_y_max))
 
-                            cropped_ds = granule_ds.where(mask, drop=True)
+                            # Locate cropped granule cells within the cube grid
+                            x_index = cube_x_index.get_indexer(granule_x[x_cells])
+                            y_index = cube_y_index.get_indexer(granule_y[y_cells])
+
+                            if np.any(x_index < 0) or np.any(y_index < 0):
+                                raise RuntimeError(f'Grid of {each_granule_s3} is not aligned with the grid of {cube_url}')
+
+                            cube_cells = ITSCube.to_outer_index(y_index, x_index)
+                            cropped_ds = granule_ds[[DataVars.M11, DataVars.M12]].isel({Coords.X: x_cells, Coords.Y: y_cells})
 
                             # Restore values in the datacube
                             for each_var in [DataVars.M11, DataVars.M12]:
@@ -275,21 +604,34 @@ class FixDatacubes:
                                 # m_values = ds[each_var][each_index, :, :].values
                                 # print(f'====>before assigning ds {each_var}: m_values.shape={m_values.shape} min={np.nanmin(m_values)} max={np.nanmax(m_values)}')
 
-                                ds[each_var][each_index, :, :].loc[dict(x=cropped_ds.x, y=cropped_ds.y)] = cropped_ds[each_var]
+                                m_arrays[each_var][each_index][cube_cells] = cropped_ds[each_var].transpose(Coords.Y, Coords.X).values
 
                                 # # Show restored values
                                 # m_values = ds[each_var][each_index, :, :].values
                                 # print(f'====>assigned ds {each_var}: m_values.shape={m_values.shape} min={np.nanmin(m_values)} max={np.nanmax(m_values)}')
 
-                            # Extract flight direction for both images of the granule
-                            ascending_img1[each_index] = granule_ds.img_pair_info.attrs[DataVars.ImgPairInfo.FLIGHT_DIRECTION_IMG1].strip() == DataVars.ImgPairInfo.ASCENDING
-                            ascending_img2[each_index] = granule_ds.img_pair_info.attrs[DataVars.ImgPairInfo.FLIGHT_DIRECTION_IMG2].strip() == DataVars.ImgPairInfo.ASCENDING
+                            # Collect flight direction for both images of the granule
+                            img_pair_attrs = granule_ds[DataVars.ImgPairInfo.NAME].attrs
+                            flight_direction_img1.append(img_pair_attrs[DataVars.ImgPairInfo.FLIGHT_DIRECTION_IMG1])
+                            flight_direction_img2.append(img_pair_attrs[DataVars.ImgPairInfo.FLIGHT_DIRECTION_IMG2])
+
+                # Set ascending flags for all S1 layers at once
+                ascending_img1[s1_indices] = np.char.strip(np.array(flight_direction_img1, dtype=str)) == DataVars.ImgPairInfo.ASCENDING
+                ascending_img2[s1_indices] = np.char.strip(np.array(flight_direction_img2, dtype=str)) == DataVars.ImgPairInfo.ASCENDING
+
+                # Store restored values in the datacube (keeps attributes and encoding of the variables)
+                for each_var in [DataVars.M11, DataVars.M12]:
+                    ds[each_var].values = m_arrays[each_var]
 
             # Add new variables to the datacube - just use existing 1-d data variable coords and dims
+            sensor_var = ds[DataVars.ImgPairInfo.SATELLITE_IMG1]
+            sensor_coords = sensor_var.coords
+            sensor_dims = sensor_var.dims
+
             ds[DataVars.ASCENDING_IMG1] = xr.DataArray(
                 data=ascending_img1,
-                coords=ds[DataVars.ImgPairInfo.SATELLITE_IMG1].coords,
-                dims=ds[DataVars.ImgPairInfo.SATELLITE_IMG1].dims
+                coords=sensor_coords,
+                dims=sensor_dims
             )
             ds[DataVars.ASCENDING_IMG1].attrs = {
                 DataVars.STD_NAME: DataVars.STANDARD_NAME[DataVars.ASCENDING_IMG1],
@@ -300,8 +642,8 @@ class FixDatacubes:
 
             ds[DataVars.ASCENDING_IMG2] = xr.DataArray(
                 data=ascending_img2,
-                coords=ds[DataVars.ImgPairInfo.SATELLITE_IMG1].coords
-                dims=ds[DataVars.ImgPairInfo.SATELLITE_IMG1].dims
+                coords=sensor_coords,
+                dims=sensor_dims
             )
             ds[DataVars.ASCENDING_IMG2].attrs = {
                 DataVars.STD_NAME: DataVars.STANDARD_NAME[DataVars.ASCENDING_IMG2],
@@ -355,46 +697,39 @@ class FixDatacubes:
                     Output.CHUNKS_ATTR: chunking_1d
                 }
 
-            msgs.append(f"Saving datacube to {fixed_file}")
-            # Re-chunk xr.Dataset to avoid memory errors when writing to the ZARR store
-            ds = ds.chunk({Coords.MID_DATE: 250})
-            ds.to_zarr(fixed_file, consolidated=True)
+            # Chunks of the variables that are not changed by the fix can be copied
+            # as is: don't decompress and re-compress them
+            copy_vars = []
+            if num_s1_layers == 0:
+                copy_vars = FixDatacubes.unchanged_vars(ds, local_original_cube)
+                msgs.append(f'Copy unchanged data variables: {copy_vars}')
 
-        if FixDatacubes.DRY_RUN:
-            return msgs
+                ds = ds.drop_vars(copy_vars)
 
-        if os.path.exists(fixed_file):
-            # Use "subprocess" as s3fs.S3FileSystem leaves unclosed connections
-            # resulting in as many error messages as there are files in Zarr store
-            # to copy
-            target_url = cube_url.replace(cube_bucket_dir, target_bucket_dir)
+            msgs.append(f"Saving datacube to {fixed_file}")
+            # Re-chunk xr.Dataset to avoid memory errors when writing to the ZARR store:
+            # Dask chunks match Zarr chunks of each data variable, so each of
+            # the chunks is compressed and written by parallel threads without locking
+            # (fixed size mid_date chunks would overlap multiple Zarr chunks)
+            for each_var in ds.data_vars:
+                chunking = ds[each_var].encoding.get(Output.CHUNKS_ATTR)
 
-            if not target_url.startswith(FixDatacubes.S3_PREFIX):
-                target_url = FixDatacubes.S3_PREFIX + target_url
+                if isinstance(chunking, tuple) and len(chunking) == ds[each_var].ndim:
+                    ds[each_var] = ds[each_var].chunk(dict(zip(ds[each_var].dims, chunking)))
 
-            command_line = [
-                "aws", "s3", "cp", "--recursive",
-                fixed_file,
-                target_url,
-                "--acl", "bucket-owner-full-control"
-            ]
+            ds.to_zarr(fixed_file, consolidated=True, compute=False).compute(scheduler='threads')
 
-            msgs.append(' '.join(command_line))
+            if len(copy_vars):
+                for each_var in copy_vars:
+                    shutil.copytree(
+                        os.path.join(local_original_cube, each_var),
+                        os.path.join(fixed_file, each_var)
+                    )
 
-            command_return = subprocess.run(
-                command_line,
-                env=env_copy,
-                check=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT
-            )
-            if command_return.returncode != 0:
-                msgs.append(f"ERROR: Failed to copy {fixed_file} to {target_url}: {command_return.stdout}")
+                # Include copied variables into consolidated metadata of the datacube
+                zarr.consolidate_metadata(fixed_file)
 
-            msgs.append(f"Removing local {fixed_file}")
-            shutil.rmtree(fixed_file)
-
-            return msgs
+        return msgs
 
 
 def main():
@@ -439,7 +774,26 @@ def main():
         '-w', '--dask-workers',
         type=int,
         default=4,
-        help='Number of Dask parallel workers [%(default)d]'
+        help='Number of datacubes to fix and upload in parallel [%(default)d]'
+    )
+    parser.add_argument(
+        '--granule_concurrency',
+        type=int,
+        default=FixDatacubes.NUM_PREFETCH_GRANULES,
+        help='Number of S1 granules to download concurrently for each of the datacubes [%(default)d]'
+    )
+    parser.add_argument(
+        '--granule_cache_dir',
+        type=str,
+        default=None,
+        help='Local directory to cache downloaded S1 granules to: neighboring datacubes share the same granules, '
+                'so each of the cached granules is downloaded only once. Granules are not cached if not provided [%(default)s]'
+    )
+    parser.add_argument(
+        '--granule_cache_size',
+        type=float,
+        default=16,
+        help='Maximum size in GB of the local granule cache [%(default)g]'
     )
     parser.add_argument(
         '-s', '--start_cube',
@@ -452,6 +806,11 @@ def main():
         action='store_true',
         help='Dry run, do not actually submit AWS push/pull commands.'
     )
+    parser.add_argument(
+        '--log_stats',
+        action='store_true',
+        help='Report min/max of original M11/M12 values of each datacube (requires a full scan of the values).'
+    )
 
     args = parser.parse_args()
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
@@ -459,13 +818,19 @@ def main():
 
     logging.info(f"Args: {args}")
     FixDatacubes.DRY_RUN = args.dryrun
+    FixDatacubes.LOG_STATS = args.log_stats
+    FixDatacubes.NUM_PREFETCH_GRANULES = args.granule_concurrency
+
+    if args.granule_cache_dir is not None:
+        FixDatacubes.GRANULE_CACHE = GranuleCache(args.granule_cache_dir, int(args.granule_cache_size*1024**3))
 
     fix_cubes = FixDatacubes(
         args.bucket,
         args.bucket_dir,
         args.target_bucket_dir,
         args.local_original_cube_dir,
-        args.local_dir
+        args.local_dir,
+        args.dask_workers
     )
 
     fix_cubes(args.dask_workers, args.start_cube)
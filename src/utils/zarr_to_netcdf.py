@@ -8,6 +8,7 @@ Convert Zarr data stored in ZarrStoreName to the NetCDF file NetCDFFileName.
 """
 
 import argparse
+from dask.diagnostics import ProgressBar
 import logging
 import numpy as np
 import os
@@ -187,28 +188,45 @@ def convert(ds_zarr: xr.Dataset, output_file: str, nc_engine: str):
     # for each in ENCODE_DATA_VARS:
     #     ENCODING.setdefault(each, {}).update(compression)
 
+    # Set encoding only for variables present in the datacube: to_netcdf()
+    # fails on encoding for variables that are not in the dataset
+    encoding = {each: each_encoding for each, each_encoding in ENCODING.items() if each in ds_zarr.variables}
+
     start_time = timeit.default_timer()
     show_memory_usage('before to_netcdf()')
-    ds_zarr.to_netcdf(
+    # Stream Dask chunks to the file: chunks are read and decompressed
+    # by parallel threads (writes to the file are serialized by the engine)
+    write_job = ds_zarr.to_netcdf(
         output_file,
         engine=nc_engine,
-        encoding=ENCODING
+        encoding=encoding,
+        compute=False
     )
+
+    with ProgressBar():
+        write_job.compute(scheduler='threads')
+
     show_memory_usage('after to_netcdf()')
 
     time_delta = timeit.default_timer() - start_time
     logging.info(f"Wrote dataset to NetCDF file {output_file} (took {time_delta} seconds)")
 
-def main(input_file: str, output_file: str, nc_engine: str, chunks_size: int):
+def main(input_file: str, output_file: str, nc_engine: str, chunks_size: int = None):
     """
     Convert datacube Zarr store to NetCDF format file.
+
+    chunks_size: Dask chunk size for mid_date coordinate. If not provided,
+        Dask chunks match chunks of the Zarr store, so each of the Zarr chunks
+        is read and decompressed only once.
     """
     start_time = timeit.default_timer()
 
     ds_zarr = None
     s3_in = None
     # Open Zarr store as Dask array to allow for stream write to NetCDF
-    dask_chunks = {'mid_date': chunks_size, 'x': 10, 'y': 10}
+    dask_chunks = {}
+    if chunks_size is not None:
+        dask_chunks = {'mid_date': chunks_size, 'x': 10, 'y': 10}
 
     show_memory_usage('before open Zarr()')
 
@@ -256,9 +274,10 @@ if __name__ == '__main__':
                         help="NetCDF engine to use to store NetCDF data to the file.")
     parser.add_argument('-b', '--outputBucket', type=str, default="",
                         help="S3 bucket to copy datacube in NetCDF format to [%(default)s].")
-    parser.add_argument('-c', '--chunks', type=int, default=250,
-                        help="Dask chunk size for mid_date coordinate [%(default)d]. " \
-                        "This is to handle datacubes that can't fit in memory, and should be read as Dask arrays.")
+    parser.add_argument('-c', '--chunks', type=int, default=None,
+                        help="Dask chunk size for mid_date coordinate [%(default)s]. " \
+                        "This is to handle datacubes that can't fit in memory, and should be read as Dask arrays. " \
+                        "If not provided, chunks of the Zarr store are used.")
 
     args = parser.parse_args()
     logging.info(f"Args: {sys.argv}")